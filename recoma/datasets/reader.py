@@ -1,4 +1,6 @@
 import abc
+import hashlib
+import logging
 import random
 from abc import abstractmethod
 from dataclasses import dataclass
@@ -7,6 +9,7 @@ from typing import List, Optional, Iterable
 
 from recoma.utils.class_utils import RegistrableFromDict
 
+logger = logging.getLogger(__name__)
 
 class Example(abc.ABC):
 
@@ -87,13 +90,39 @@ class DatasetReader(RegistrableFromDict):
         """
         raise NotImplementedError
 
-    def get_examples(self, file: Optional[str] = None) -> Iterable[Example]:
+    def get_examples(self, file: Optional[str] = None, shard_index: int = 0,
+                     num_shards: int = 1, shard_by: str = "hash") -> Iterable[Example]:
         """
         Get examples from the input file by first reading them from file and then applying
         filters as defined in the constructor (e.g. top_k, sample_p)
         :param file: input file to read from
+        :param shard_index: only return the examples in this shard (0-indexed)
+        :param num_shards: number of shards to split the examples into
+        :param shard_by: assign examples to shards by a stable hash of the unique_id ("hash") or
+        by their position after filtering ("position")
         :return: streaming Example objects (subject to conditions in constructor)
         """
+        if num_shards == 1:
+            yield from self.filter_examples(file)
+            return
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("Shard index: {} should be in [0, {})".format(shard_index, num_shards))
+        if self.sample_p and not self.top_k:
+            logger.warning("Random sampling with sample_p is not consistent across shards!")
+        for position, example in enumerate(self.filter_examples(file)):
+            if shard_by == "hash":
+                shard_key = int(hashlib.md5(example.unique_id.encode("utf-8")).hexdigest(), 16)
+            elif shard_by == "position":
+                shard_key = position
+            else:
+                raise ValueError("Unknown shard_by: {}".format(shard_by))
+            if shard_key % num_shards == shard_index:
+                yield example
+
+    def filter_examples(self, file: Optional[str] = None) -> Iterable[Example]:
+        """
+        Read the examples from the input file and apply the filters defined in the constructor
+        """
         if self.top_k:
             counter = 0
             for example in self.read_examples(file):
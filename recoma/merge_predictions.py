@@ -0,0 +1,95 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from recoma.utils.prediction_writer import read_all_data, summarize_all_data
+
+logger = logging.getLogger(__name__)
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(
+        description='Merge the outputs of sharded inference runs (--num_shards) into one output')
+    arg_parser.add_argument('--input_dirs', type=str, nargs="+", required=True,
+                            help="Output directories of the individual shards")
+    arg_parser.add_argument('--output_dir', type=str, required=True,
+                            help="Output directory for the merged predictions")
+    arg_parser.add_argument('--debug', action='store_true', default=False,
+                            help="Debug output")
+    return arg_parser.parse_args()
+
+
+def copy_dir_contents(input_dir: str, output_dir: str):
+    """
+    Copy all the files in input_dir (if it exists) into output_dir
+    """
+    if not os.path.isdir(input_dir):
+        return
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for filename in os.listdir(input_dir):
+        input_file = os.path.join(input_dir, filename)
+        if os.path.isfile(input_file):
+            shutil.copy2(input_file, os.path.join(output_dir, filename))
+
+
+def merge_predictions(input_dirs, output_dir):
+    """
+    Merge the all_data.jsonl, prompt dumps and rendered traces from the shard output directories
+    into output_dir and re-compute predictions.json, counters.json and the EM score over all the
+    examples
+    :param input_dirs: shard output directories
+    :param output_dir: merged output directory
+    """
+    if os.path.abspath(output_dir) in [os.path.abspath(input_dir) for input_dir in input_dirs]:
+        raise ValueError("Output directory: {} should not be one of the input "
+                         "directories".format(output_dir))
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    merged_data = {}
+    source_config = None
+    for input_dir in input_dirs:
+        all_data_file = input_dir + "/all_data.jsonl"
+        if not os.path.exists(all_data_file):
+            raise ValueError("No all_data.jsonl found in {}".format(input_dir))
+        shard_data = read_all_data(all_data_file)
+        logger.info("Read {} examples from {}".format(len(shard_data), input_dir))
+        for unique_id, line_json in shard_data.items():
+            if unique_id in merged_data:
+                logger.warning("Example: {} found in multiple shards. "
+                               "Using the entry from {}".format(unique_id, input_dir))
+                merged_data.pop(unique_id)
+            merged_data[unique_id] = line_json
+
+        config_file = input_dir + "/source_config.json"
+        if os.path.exists(config_file):
+            with open(config_file, "r") as input_fp:
+                shard_config = json.load(input_fp)
+            if source_config is None:
+                source_config = shard_config
+            elif shard_config != source_config:
+                logger.warning("Config in {} differs from the first shard!".format(input_dir))
+
+        copy_dir_contents(input_dir + "/prompts_dump", output_dir + "/prompts_dump")
+        copy_dir_contents(input_dir + "/files", output_dir + "/files")
+
+    with open(output_dir + "/all_data.jsonl", "w") as output_fp:
+        for line_json in merged_data.values():
+            output_fp.write(json.dumps(line_json) + "\n")
+    if source_config is not None:
+        with open(output_dir + "/source_config.json", "w") as output_fp:
+            json.dump(source_config, output_fp, indent=2)
+    summarize_all_data(merged_data, output_dir)
+
+
+def main():
+    parsed_args = parse_arguments()
+    logging.basicConfig(level=logging.ERROR)
+    if parsed_args.debug:
+        logging.getLogger('recoma').setLevel(level=logging.DEBUG)
+    merge_predictions(parsed_args.input_dirs, parsed_args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
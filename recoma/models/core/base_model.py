@@ -1,6 +1,11 @@
-from typing import Optional, List
+import asyncio
+import hashlib
+import json
+import re
+from typing import Any, Dict, List, Optional, Sequence
 
 from recoma.models.core.generator import GenerationOutputs
+from recoma.models.core.llm_cache import LLMCache, get_shared_cache
 from recoma.search.state import SearchState
 from recoma.utils.class_utils import RegistrableFromDict
 
@@ -13,8 +18,94 @@ class BaseModel(RegistrableFromDict):
     assigned to this base model. Each model must process this open node and create new states by
     adding new nodes (assigned to other models) to the search state.
     """
-    def __init__(self, next_model: Optional[str] = None):
+    def __init__(self, next_model: Optional[str] = None, memoize: Optional[bool] = None,
+                 answer_cache: Optional[Dict[str, Any]] = None,
+                 answer_cache_fields: Sequence[str] = ("paras",)):
+        """
+        :param next_model: model assigned to the output of this model
+        :param memoize: re-use the completed subtree of an earlier node assigned to this model with
+        the same input in the same example (instead of calling the model again). Defaults to
+        can_memoize().
+        :param answer_cache: config for the LLMCache used to share the outputs of this model across
+        examples (and runs), e.g. {"type": "disk", "directory": "~/.cache/recoma_answers"}. Only
+        used if the model can be memoized.
+        :param answer_cache_fields: example fields (e.g. the paragraphs) that the outputs depend on
+        and are part of the answer cache key along with the normalized input string
+        """
         self.next_model = next_model
+        self.memoize = memoize
+        self.answer_cache: Optional[LLMCache] = get_shared_cache(answer_cache) \
+            if answer_cache else None
+        self.answer_cache_fields = list(answer_cache_fields)
+
+    def can_memoize(self) -> bool:
+        """
+        Whether this model produces the same subtree for the same input string in an example, i.e.
+        whether its outputs can be memoized. Only deterministic models should return True.
+        """
+        return False
+
+    def should_memoize(self) -> bool:
+        return self.can_memoize() if self.memoize is None else self.memoize
+
+    def cache_fingerprint(self) -> str:
+        """
+        String identifying the configuration that the outputs of this model depend on (e.g. the
+        prompt), so that the answer cache is not re-used after the model has changed
+        """
+        return type(self).__name__
+
+    def answer_cache_key(self, target_model: str, input_str: str, state: SearchState) -> tuple:
+        """
+        Key for the answer cache based on the target model, the normalized input string and a
+        fingerprint of the relevant example fields
+        """
+        normalized_input = re.sub(r"\s+", " ", input_str.lower()).strip().rstrip("?.!").strip()
+        field_values = [state.example.get_field(field) for field in self.answer_cache_fields
+                        if field in state.example.fields()]
+        fields_fingerprint = hashlib.sha1(
+            json.dumps(field_values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return "answer", target_model, self.cache_fingerprint(), normalized_input, \
+            fields_fingerprint
+
+    def get_cached_answer(self, target_model: str, input_str: str,
+                          state: SearchState) -> Optional[str]:
+        """
+        :return: the cached output for this input or None (also if there is no answer cache). The
+        cache hit/miss is added to the state counters.
+        """
+        if self.answer_cache is None:
+            return None
+        answer = self.answer_cache.get(self.answer_cache_key(target_model, input_str, state))
+        self.record_answer_cache(target_model, state, is_hit=answer is not None)
+        return answer
+
+    async def aget_cached_answer(self, target_model: str, input_str: str,
+                                 state: SearchState) -> Optional[str]:
+        if self.answer_cache is None:
+            return None
+        answer = await self.answer_cache.aget(
+            self.answer_cache_key(target_model, input_str, state))
+        self.record_answer_cache(target_model, state, is_hit=answer is not None)
+        return answer
+
+    def set_cached_answer(self, target_model: str, input_str: str, state: SearchState,
+                          answer: str):
+        if self.answer_cache is not None:
+            self.answer_cache.set(self.answer_cache_key(target_model, input_str, state), answer)
+
+    async def aset_cached_answer(self, target_model: str, input_str: str, state: SearchState,
+                                 answer: str):
+        if self.answer_cache is not None:
+            await self.answer_cache.aset(self.answer_cache_key(target_model, input_str, state),
+                                         answer)
+
+    @staticmethod
+    def record_answer_cache(target_model: str, state: SearchState, is_hit: bool):
+        if is_hit:
+            state.update_counter(target_model + ".answer_cache_hit", 1)
+        else:
+            state.update_counter(target_model + ".answer_cache_miss", 1)
 
     def __call__(self, state: SearchState) -> List[SearchState]:
         """
@@ -28,6 +119,29 @@ class BaseModel(RegistrableFromDict):
         new_states = self.build_new_states(state, generation_outputs)
         return new_states
 
+    async def acall(self, state: SearchState) -> List[SearchState]:
+        """
+        Async version of __call__. Models that only override generate_output can implement
+        agenerate_output to avoid blocking the event loop. Models with a custom __call__ (and no
+        acall) are run in a worker thread.
+        :param state: input state
+        :return: list of new search states
+        """
+        if type(self).__call__ is not BaseModel.__call__:
+            return await asyncio.to_thread(self, state)
+        generation_outputs = await self.agenerate_output(state)
+        new_states = self.build_new_states(state, generation_outputs)
+        return new_states
+
+    async def agenerate_output(self, state: SearchState) -> GenerationOutputs:
+        """
+        Async version of generate_output. Runs the (possibly blocking) generate_output in a worker
+        thread unless it is the default pass-through implementation.
+        """
+        if type(self).generate_output is BaseModel.generate_output:
+            return self.generate_output(state)
+        return await asyncio.to_thread(self.generate_output, state)
+
     def generate_output(self, state: SearchState) -> GenerationOutputs:
         # pass through without making any change
         open_node = state.get_open_node()
@@ -53,7 +167,7 @@ class BaseModel(RegistrableFromDict):
         """
         new_states = []
         for idx, output_str in enumerate(generation_outputs.outputs):
-            new_state = state.clone(deep=True)
+            new_state = state.clone()
             current_node = new_state.get_open_node()
             if current_node is None:
                 raise ValueError("Model called without any open node!!")
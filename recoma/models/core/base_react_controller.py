@@ -20,6 +20,9 @@ class BaseReactController(ABC, BaseModel):
         self.add_roles = add_roles
         self.max_output_length = max_output_length
 
+    def can_memoize(self) -> bool:
+        return True
+
     @abstractmethod
     def summarize_history(self, history: List[Any]) -> str:
         """Summarize the history of the conversation"""
@@ -109,7 +112,7 @@ class BaseReactController(ABC, BaseModel):
             return self.next_step_and_action_input(state, last_child)
 
     def __call__(self, state: SearchState) -> List[SearchState]:
-        new_state = state.clone(deep=True)
+        new_state = state.clone()
         current_node = self.get_react_node(new_state)
         children = self.get_children(new_state)
         last_child = children[-1] if children else None
@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import json
+import logging
+from abc import abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from recoma.search.state import SearchState
+from recoma.utils.class_utils import RegistrableFromDict
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchRequest:
+    """
+    An API request from a generator that is collected into a batch
+    """
+    # LMGenerator that made the request
+    generator: Any
+    # function that sends the request, i.e. function(**generator_args)
+    function: Callable[..., Any]
+    generator_args: Dict[str, Any]
+    state: SearchState
+    counter_prefix: str
+    # whether function is a coroutine function
+    is_async: bool = True
+    futures: List[asyncio.Future] = field(default_factory=list)
+
+
+class BatchBackend(RegistrableFromDict):
+    """
+    Sends a batch of API requests collected from all the active examples and returns their
+    responses
+    """
+
+    @abstractmethod
+    async def arun(self, requests: List[BatchRequest]) -> List[Any]:
+        """
+        :return: the response (or the exception) for each request
+        """
+        raise NotImplementedError
+
+
+@BatchBackend.register("concurrent")
+class ConcurrentBatchBackend(BatchBackend):
+    """
+    Sends all the requests in the batch concurrently using the generators' regular (async) API
+    calls, i.e. with their rate limits, retries and hedging
+    """
+
+    async def arun(self, requests: List[BatchRequest]) -> List[Any]:
+        return await asyncio.gather(*[self.arun_request(request) for request in requests],
+                                    return_exceptions=True)
+
+    @staticmethod
+    async def arun_request(request: BatchRequest) -> Any:
+        if request.is_async:
+            return await request.generator.acall_with_retries(
+                request.function, request.state, request.counter_prefix,
+                **request.generator_args)
+        return await asyncio.to_thread(request.generator.call_with_retries, request.function,
+                                       request.state, request.counter_prefix,
+                                       **request.generator_args)
+
+
+@BatchBackend.register("openai_batch")
+class OpenAIBatchBackend(BatchBackend):
+    """
+    Sends the requests as a JSONL batch via the OpenAI Batch API (files + batches endpoints), which
+    is also implemented by some local OpenAI-compatible servers. Requests from generators that do
+    not support the batch API (supports_batch_api = False) are sent concurrently instead.
+    """
+
+    def __init__(self, poll_interval: float = 30, completion_window: str = "24h", **kwargs):
+        """
+        :param poll_interval: seconds between checks of the batch status
+        :param completion_window: completion window for the batch
+        """
+        super().__init__(**kwargs)
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.fallback_backend = ConcurrentBatchBackend()
+
+    async def arun(self, requests: List[BatchRequest]) -> List[Any]:
+        responses: List[Any] = [None] * len(requests)
+        # group the requests by the client (i.e. base url) that they should be sent to
+        groups: Dict[int, List[int]] = {}
+        fallback_indices = []
+        for idx, request in enumerate(requests):
+            if getattr(request.generator, "supports_batch_api", False):
+                groups.setdefault(id(request.generator.async_client), []).append(idx)
+            else:
+                fallback_indices.append(idx)
+        tasks = [self.arun_batch([requests[idx] for idx in indices]) for indices in groups.values()]
+        tasks.append(self.fallback_backend.arun([requests[idx] for idx in fallback_indices]))
+        group_responses = await asyncio.gather(*tasks)
+        for indices, group_response in zip(list(groups.values()) + [fallback_indices],
+                                           group_responses):
+            for idx, response in zip(indices, group_response):
+                responses[idx] = response
+        return responses
+
+    async def arun_batch(self, requests: List[BatchRequest]) -> List[Any]:
+        from openai.types.chat.chat_completion import ChatCompletion
+        client = requests[0].generator.async_client
+        lines = [json.dumps({"custom_id": str(idx), "method": "POST",
+                             "url": "/v1/chat/completions", "body": request.generator_args})
+                 for idx, request in enumerate(requests)]
+        try:
+            input_file = await client.files.create(
+                file=("batch.jsonl", ("\n".join(lines) + "\n").encode("utf-8")), purpose="batch")
+            batch = await client.batches.create(input_file_id=input_file.id,
+                                                endpoint="/v1/chat/completions",
+                                                completion_window=self.completion_window)
+            logger.info("Submitted batch: {} with {} requests".format(batch.id, len(requests)))
+            while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+                await asyncio.sleep(self.poll_interval)
+                batch = await client.batches.retrieve(batch.id)
+        except Exception as e:
+            logger.exception("Batch request failed")
+            return [e] * len(requests)
+        if batch.status != "completed":
+            error = ValueError("Batch: {} {}: {}".format(batch.id, batch.status, batch.errors))
+            return [error] * len(requests)
+
+        responses: List[Any] = [ValueError("No response for request in batch: {}".format(batch.id))
+                                ] * len(requests)
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if not file_id:
+                continue
+            file_content = await client.files.content(file_id)
+            for line in file_content.text.splitlines():
+                if not line.strip():
+                    continue
+                line_json = json.loads(line)
+                idx = int(line_json["custom_id"])
+                response = line_json.get("response") or {}
+                if response.get("status_code") == 200:
+                    responses[idx] = ChatCompletion.model_validate(response["body"])
+                else:
+                    responses[idx] = ValueError("Batch request failed: {}".format(
+                        line_json.get("error") or response.get("body")))
+        return responses
+
+
+_batch_collector: contextvars.ContextVar[Optional["BatchCollector"]] = \
+    contextvars.ContextVar("batch_collector", default=None)
+
+
+def get_batch_collector() -> Optional["BatchCollector"]:
+    """
+    :return: the batch collector for the current (batched) search, if any
+    """
+    return _batch_collector.get()
+
+
+class BatchCollector:
+    """
+    Collects the API requests made by the active examples' expansions. Once every active expansion
+    is waiting on a request (or has finished), the collected requests are sent as one batch via the
+    backend. Identical greedy requests within a batch are only sent once.
+    """
+
+    def __init__(self, backend: BatchBackend, max_batch_size: Optional[int] = None):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: List[BatchRequest] = []
+        self._pending_by_key: Dict[str, BatchRequest] = {}
+        self._num_active = 0
+        self._num_waiting = 0
+        self._batch_tasks = set()
+
+    def activate(self):
+        """
+        Make this the collector for the tasks created from the current context
+        :return: token to reset the context
+        """
+        self.loop = asyncio.get_running_loop()
+        return _batch_collector.set(self)
+
+    @staticmethod
+    def deactivate(token):
+        _batch_collector.reset(token)
+
+    def add_active(self, num_active: int):
+        """
+        Register the number of expansions that will run (and make requests) concurrently
+        """
+        self._num_active += num_active
+
+    async def run(self, coroutine):
+        """
+        Run an expansion registered with add_active
+        """
+        try:
+            return await coroutine
+        finally:
+            self._num_active -= 1
+            self._maybe_flush()
+
+    async def submit(self, request: BatchRequest) -> Any:
+        """
+        Add the request to the next batch and wait for its response
+        """
+        request.state.update_counter(request.counter_prefix + ".batched", 1)
+        future = asyncio.get_running_loop().create_future()
+        key = None
+        if request.generator_args.get("temperature") == 0:
+            key = type(request.generator).__name__ + json.dumps(request.generator_args,
+                                                                 sort_keys=True, default=str)
+        if key is not None and key in self._pending_by_key:
+            self._pending_by_key[key].futures.append(future)
+        else:
+            request.futures.append(future)
+            self._pending.append(request)
+            if key is not None:
+                self._pending_by_key[key] = request
+        self._num_waiting += 1
+        try:
+            self._maybe_flush()
+            return await future
+        finally:
+            self._num_waiting -= 1
+
+    def submit_threadsafe(self, request: BatchRequest) -> Any:
+        """
+        Submit the request from a worker thread (e.g. a synchronous generate call) and block until
+        its response is available
+        """
+        return asyncio.run_coroutine_threadsafe(self.submit(request), self.loop).result()
+
+    def _maybe_flush(self):
+        if not self._pending:
+            return
+        if self._num_waiting >= self._num_active or (
+                self.max_batch_size and len(self._pending) >= self.max_batch_size):
+            batch = self._pending
+            self._pending = []
+            self._pending_by_key = {}
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            # keep a reference to the task till it is done
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[BatchRequest]):
+        # requests made by the backend itself should not be batched again
+        _batch_collector.set(None)
+        logger.debug("Sending batch of {} requests".format(len(batch)))
+        try:
+            responses = await self.backend.arun(batch)
+        except Exception as e:
+            responses = [e] * len(batch)
+        for request, response in zip(batch, responses):
+            for future in request.futures:
+                if future.done():
+                    continue
+                if isinstance(response, BaseException):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """
+    Errors that indicate that the provider is overloaded or rate limiting us (429s and timeouts)
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    if getattr(error, "status_code", None) == 429:
+        return True
+    error_name = type(error).__name__
+    return "RateLimit" in error_name or "Timeout" in error_name
+
+
+class ConcurrencyGovernor:
+    """
+    Adaptive limit on the number of in-flight API requests using AIMD (additive increase,
+    multiplicative decrease). The limit grows by ~1 for every limit-many successful requests with a
+    healthy latency and is cut by decrease_factor on an overload error (429 or timeout) or when the
+    latency spikes above latency_spike_factor times the typical latency. Can be used from threads
+    and event loops at the same time.
+    """
+
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 256,
+                 decrease_factor: float = 0.5, latency_spike_factor: Optional[float] = 3.0,
+                 latency_smoothing: float = 0.1, **kwargs):
+        """
+        :param initial_limit: initial number of in-flight requests
+        :param min_limit: min number of in-flight requests
+        :param max_limit: max number of in-flight requests
+        :param decrease_factor: multiply the limit by this factor on overload
+        :param latency_spike_factor: treat requests slower than this factor times the average
+        latency as overload. Set to None to only use errors
+        :param latency_smoothing: weight of each new latency in the moving average
+        """
+        if kwargs:
+            logger.warning("Ignoring unknown concurrency governor params: {}".format(kwargs))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.latency_smoothing = latency_smoothing
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._avg_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Block until a request can be sent
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def aacquire(self):
+        """
+        Async version of acquire
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < self.limit:
+                    self._in_flight += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            finally:
+                with self._condition:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def release(self, latency: float, error: Optional[BaseException] = None):
+        """
+        Release the slot of a finished request and adapt the limit based on its outcome
+        :param latency: seconds taken by the request
+        :param error: exception raised by the request, if any. Requests that were cancelled (i.e.
+        raised a BaseException that is not an Exception, such as asyncio.CancelledError) say nothing
+        about the provider's health, so they do not change the limit or the average latency.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            old_limit = self.limit
+            if error is not None and not isinstance(error, Exception):
+                pass
+            elif error is not None:
+                if is_overload_error(error):
+                    self._decrease()
+            elif (self.latency_spike_factor and self._avg_latency is not None and
+                  latency > self.latency_spike_factor * self._avg_latency):
+                self._decrease()
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if error is None:
+                self._avg_latency = latency if self._avg_latency is None else (
+                        (1 - self.latency_smoothing) * self._avg_latency +
+                        self.latency_smoothing * latency)
+            if self.limit != old_limit:
+                logger.info("Concurrency limit: {} -> {}".format(old_limit, self.limit))
+            self._condition.notify_all()
+            # Wake up the async waiters to re-check the limit
+            for loop, future in self._async_waiters:
+                loop.call_soon_threadsafe(_set_future_done, future)
+            self._async_waiters.clear()
+
+    def _decrease(self):
+        current_time = time.monotonic()
+        # Requests in flight at the time of the first failure would fail together, so cut the limit
+        # at most once per (average) round trip
+        if current_time - self._last_decrease < (self._avg_latency or 0):
+            return
+        self._last_decrease = current_time
+        self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+
+
+def _set_future_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_governors: Dict[str, ConcurrencyGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def get_concurrency_governor(name: str = "default", **kwargs) -> ConcurrencyGovernor:
+    """
+    Get the concurrency governor with this name. All generators configured with the same name share
+    the governor (and hence the limit). The params from the first call are used.
+    """
+    with _governors_lock:
+        if name not in _governors:
+            _governors[name] = ConcurrencyGovernor(**kwargs)
+        return _governors[name]
@@ -1,13 +1,34 @@
+import asyncio
 import json
+import logging
 import re
+import time
 from abc import abstractmethod
-from ast import List
 from dataclasses import dataclass, field
-from typing import Any, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional
 
+from recoma.models.core.batch_backend import BatchRequest, get_batch_collector
+from recoma.models.core.concurrency_governor import (ConcurrencyGovernor,
+                                                     get_concurrency_governor)
+from recoma.models.core.llm_cache import LLMCache, get_shared_cache
+from recoma.models.core.rate_limiter import RateLimiter, get_rate_limiter
+from recoma.models.core.request_coalescer import request_coalescer
+from recoma.models.core.request_hedger import RequestHedger, get_request_hedger
+from recoma.models.core.retry_policy import RetryPolicy
+from recoma.search.deadline import check_deadline
 from recoma.search.state import SearchState
 from recoma.utils.class_utils import RegistrableFromDict
 
+logger = logging.getLogger(__name__)
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
 
 @dataclass
 class GeneratorParams:
@@ -37,9 +58,49 @@ class LMGenerator(RegistrableFromDict):
     Base LM Generator class. All text-to-text generators should inherit this base registrable class
     and implement the generate method
     """
+    # Whether the requests (from call_with_retries) can be sent via the OpenAI batch API
+    supports_batch_api = False
 
-    def __init__(self, drop_params=[], **kwargs):
+    def __init__(self, drop_params=[], cache: Optional[Dict[str, Any]] = None,
+                 coalesce_requests: bool = True, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 concurrency: Optional[Dict[str, Any]] = None,
+                 retry: Optional[Dict[str, Any]] = None,
+                 hedge: Optional[Dict[str, Any]] = None,
+                 http_pool: Optional[Dict[str, Any]] = None, **kwargs):
+        """
+        :param drop_params: generator params that should not be passed to the API
+        :param cache: config for the LLMCache used to cache the responses, e.g.
+        {"type": "disk", "directory": "~/.cache/litellmcalls", "size_limit": 1e9, "expire": 86400}.
+        Generators with the same cache config share the same cache.
+        :param coalesce_requests: concurrent identical (deterministic) requests share a single API
+        call
+        :param requests_per_minute: max API requests per minute (shared by all generators for the
+        same model)
+        :param tokens_per_minute: max (prompt + completion) tokens per minute (shared by all
+        generators for the same model)
+        :param concurrency: config for the adaptive ConcurrencyGovernor limiting the in-flight
+        requests, e.g. {"initial_limit": 8, "max_limit": 64}. Generators with the same "name"
+        (default: "default") share the governor
+        :param retry: params for the RetryPolicy, e.g. {"max_attempts": 5, "max_retry_time": 120}
+        :param hedge: params for the RequestHedger to send a duplicate of slow requests, e.g.
+        {"percentile": 95, "budget": 0.05} (shared by all generators for the same model)
+        :param http_pool: connection pool config for the (shared) HTTP client, e.g.
+        {"max_connections": 100, "max_keepalive_connections": 20, "keepalive_expiry": 30}
+        """
         self.drop_params = drop_params
+        self.cache: Optional[LLMCache] = get_shared_cache(cache) if cache else None
+        self.coalesce_requests = coalesce_requests
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._rate_limiter: Optional[RateLimiter] = None
+        self.concurrency_governor: Optional[ConcurrencyGovernor] = None
+        if concurrency is not None:
+            self.concurrency_governor = get_concurrency_governor(**concurrency)
+        self.retry_policy = RetryPolicy(**(retry or {}))
+        self.hedge = hedge
+        self._request_hedger: Optional[RequestHedger] = None
+        self.http_pool = http_pool
         self.generator_params = GeneratorParams(**kwargs)
 
     @abstractmethod
@@ -50,6 +111,305 @@ class LMGenerator(RegistrableFromDict):
         """
         raise NotImplementedError
 
+    async def agenerate(self, input_str: str, current_state: SearchState) -> GenerationOutputs:
+        """
+        Async version of the generate function. By default, the blocking generate function is run
+        in a worker thread. Implementations with a native async client should override this to
+        avoid tying up a thread per call.
+        """
+        return await asyncio.to_thread(self.generate, input_str, current_state)
+
+    @property
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        if self._rate_limiter is None and (self.requests_per_minute or self.tokens_per_minute):
+            # created lazily since the model name is set by the subclasses
+            self._rate_limiter = get_rate_limiter(getattr(self, "model", type(self).__name__),
+                                                  requests_per_minute=self.requests_per_minute,
+                                                  tokens_per_minute=self.tokens_per_minute)
+        return self._rate_limiter
+
+    @property
+    def request_hedger(self) -> Optional[RequestHedger]:
+        if self._request_hedger is None and self.hedge is not None:
+            self._request_hedger = get_request_hedger(getattr(self, "model", type(self).__name__),
+                                                      **self.hedge)
+        return self._request_hedger
+
+    @staticmethod
+    def estimate_tokens(generator_args: Dict[str, Any]) -> int:
+        """
+        Rough estimate of the tokens used by a request (~4 characters per prompt token and the max
+        completion tokens for each sequence) before it is sent
+        """
+        num_chars = sum(len(message.get("content") or "")
+                        for message in generator_args.get("messages", []))
+        max_tokens = (generator_args.get("max_tokens") or
+                      generator_args.get("max_completion_tokens") or 0)
+        return num_chars // 4 + max_tokens * (generator_args.get("n") or 1)
+
+    @staticmethod
+    def response_tokens(response) -> Optional[int]:
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "total_tokens", None)
+
+    def throttled_call(self, function: Callable[..., Any], **generator_args) -> Any:
+        """
+        Call function(**generator_args) once the rate limiter and the concurrency governor admit the
+        request
+        """
+        rate_limiter = self.rate_limiter
+        governor = self.concurrency_governor
+        if rate_limiter is None and governor is None:
+            return function(**generator_args)
+        estimated_tokens = self.estimate_tokens(generator_args)
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimated_tokens)
+        if governor is not None:
+            governor.acquire()
+        actual_tokens = 0
+        start_time = time.monotonic()
+        error = None
+        try:
+            response = function(**generator_args)
+            actual_tokens = self.response_tokens(response)
+            return response
+        except BaseException as e:
+            error = e
+            if not isinstance(e, Exception):
+                # interrupted: the request may still have been processed by the provider
+                actual_tokens = None
+            raise
+        finally:
+            if governor is not None:
+                governor.release(time.monotonic() - start_time, error)
+            if rate_limiter is not None:
+                rate_limiter.correct(estimated_tokens,
+                                     estimated_tokens if actual_tokens is None else actual_tokens)
+
+    async def athrottled_call(self, function: Callable[..., Awaitable[Any]],
+                              **generator_args) -> Any:
+        """
+        Async version of throttled_call
+        """
+        rate_limiter = self.rate_limiter
+        governor = self.concurrency_governor
+        if rate_limiter is None and governor is None:
+            return await function(**generator_args)
+        estimated_tokens = self.estimate_tokens(generator_args)
+        if rate_limiter is not None:
+            await rate_limiter.aacquire(estimated_tokens)
+        if governor is not None:
+            try:
+                await governor.aacquire()
+            except asyncio.CancelledError:
+                if rate_limiter is not None:
+                    rate_limiter.correct(estimated_tokens, 0)
+                raise
+        actual_tokens = 0
+        start_time = time.monotonic()
+        error = None
+        try:
+            response = await function(**generator_args)
+            actual_tokens = self.response_tokens(response)
+            return response
+        except BaseException as e:
+            # includes asyncio.CancelledError, e.g. when the example runs out of time
+            error = e
+            if not isinstance(e, Exception):
+                # cancelled mid-flight: the request may still have been processed by the provider
+                actual_tokens = None
+            raise
+        finally:
+            if governor is not None:
+                governor.release(time.monotonic() - start_time, error)
+            if rate_limiter is not None:
+                rate_limiter.correct(estimated_tokens,
+                                     estimated_tokens if actual_tokens is None else actual_tokens)
+
+    def hedged_call(self, function: Callable[..., Any], current_state: SearchState,
+                    counter_prefix: str, **generator_args) -> Any:
+        """
+        Call function(**generator_args) via throttled_call and, once the request has been admitted,
+        hedge the provider call with a duplicate request if it is slow. The hedger only observes
+        the provider latency (not the time spent waiting on the rate limiter or the governor).
+        Hedged requests (and the hedges that won) are counted in current_state under
+        counter_prefix.
+        """
+        hedger = self.request_hedger
+        if hedger is None:
+            return self.throttled_call(function, **generator_args)
+
+        def provider_call(**args):
+            response, is_hedged, hedge_won = hedger.call(lambda: function(**args))
+            self.record_hedge(current_state, counter_prefix, is_hedged, hedge_won, args)
+            return response
+
+        return self.throttled_call(provider_call, **generator_args)
+
+    async def ahedged_call(self, function: Callable[..., Awaitable[Any]],
+                           current_state: SearchState, counter_prefix: str,
+                           **generator_args) -> Any:
+        """
+        Async version of hedged_call
+        """
+        hedger = self.request_hedger
+        if hedger is None:
+            return await self.athrottled_call(function, **generator_args)
+
+        async def provider_call(**args):
+            response, is_hedged, hedge_won = await hedger.acall(lambda: function(**args))
+            self.record_hedge(current_state, counter_prefix, is_hedged, hedge_won, args)
+            return response
+
+        return await self.athrottled_call(provider_call, **generator_args)
+
+    def record_hedge(self, current_state: SearchState, counter_prefix: str, is_hedged: bool,
+                     hedge_won: bool, generator_args: Dict[str, Any]):
+        if is_hedged:
+            current_state.update_counter(counter_prefix + ".hedges", 1)
+            if self.rate_limiter is not None:
+                # the duplicate request also uses up the token budget
+                self.rate_limiter.correct(0, self.estimate_tokens(generator_args))
+        if hedge_won:
+            current_state.update_counter(counter_prefix + ".hedge_wins", 1)
+
+    def call_with_retries(self, function: Callable[..., Any], current_state: SearchState,
+                          counter_prefix: str, **generator_args) -> Any:
+        """
+        Call function(**generator_args) (via hedged_call), retrying retryable errors as per the
+        retry policy. Fatal errors (e.g. invalid requests) are raised right away. The number of
+        retries and the time spent on them are counted in current_state under counter_prefix.
+        In a batched search, the request is added to the current batch instead.
+        """
+        collector = get_batch_collector()
+        if collector is not None and not _in_event_loop():
+            return collector.submit_threadsafe(BatchRequest(self, function, generator_args,
+                                                            current_state, counter_prefix,
+                                                            is_async=False))
+        start_time = time.monotonic()
+        first_failure_time = None
+        attempt = 0
+        try:
+            while True:
+                check_deadline()
+                attempt += 1
+                try:
+                    return self.hedged_call(function, current_state, counter_prefix,
+                                            **generator_args)
+                except Exception as e:
+                    current_time = time.monotonic()
+                    wait_time = self.retry_policy.get_wait_time(e, attempt,
+                                                                current_time - start_time)
+                    if wait_time is None:
+                        raise
+                    # do not retry past the deadline of the example
+                    check_deadline(wait_time)
+                    if first_failure_time is None:
+                        first_failure_time = current_time
+                    logger.debug("Retrying in {:.2f}s after error: {!r}".format(wait_time, e))
+                    current_state.update_counter(counter_prefix + ".retries", 1)
+                    time.sleep(wait_time)
+        finally:
+            if first_failure_time is not None:
+                current_state.update_counter(counter_prefix + ".retry_time",
+                                             time.monotonic() - first_failure_time)
+
+    async def acall_with_retries(self, function: Callable[..., Awaitable[Any]],
+                                 current_state: SearchState, counter_prefix: str,
+                                 **generator_args) -> Any:
+        """
+        Async version of call_with_retries
+        """
+        collector = get_batch_collector()
+        if collector is not None:
+            return await collector.submit(BatchRequest(self, function, generator_args,
+                                                       current_state, counter_prefix))
+        start_time = time.monotonic()
+        first_failure_time = None
+        attempt = 0
+        try:
+            while True:
+                check_deadline()
+                attempt += 1
+                try:
+                    return await self.ahedged_call(function, current_state, counter_prefix,
+                                                   **generator_args)
+                except Exception as e:
+                    current_time = time.monotonic()
+                    wait_time = self.retry_policy.get_wait_time(e, attempt,
+                                                                current_time - start_time)
+                    if wait_time is None:
+                        raise
+                    # do not retry past the deadline of the example
+                    check_deadline(wait_time)
+                    if first_failure_time is None:
+                        first_failure_time = current_time
+                    logger.debug("Retrying in {:.2f}s after error: {!r}".format(wait_time, e))
+                    current_state.update_counter(counter_prefix + ".retries", 1)
+                    await asyncio.sleep(wait_time)
+        finally:
+            if first_failure_time is not None:
+                current_state.update_counter(counter_prefix + ".retry_time",
+                                             time.monotonic() - first_failure_time)
+
+    def record_concurrency_limit(self, current_state: SearchState, counter_prefix: str):
+        if self.concurrency_governor is not None:
+            # gauge, not a counter
+            current_state.data[counter_prefix + ".concurrency_limit"] = \
+                self.concurrency_governor.limit
+
+    def call_with_cache(self, request_key: Optional[tuple], function: Callable[[], Any],
+                        current_state: SearchState, counter_prefix: str) -> Any:
+        """
+        Make the API request using function, unless the response is in the cache or an identical
+        request is already in flight. Coalesced requests are counted in current_state under
+        counter_prefix + ".coalesced".
+        :param request_key: key identifying the request or None if the request is not
+        deterministic (i.e., should neither be cached nor coalesced)
+        :param function: makes the API request and returns the response
+        """
+        self.record_concurrency_limit(current_state, counter_prefix)
+        if request_key is None:
+            return function()
+        if self.cache is not None:
+            cache = self.cache
+
+            def call():
+                return cache.get_or_call(request_key, function, current_state, counter_prefix)
+        else:
+            call = function
+        # requests in a batched search are de-duplicated by the batch collector instead
+        if not self.coalesce_requests or get_batch_collector() is not None:
+            return call()
+        response, is_shared = request_coalescer.call(request_key, call)
+        if is_shared:
+            current_state.update_counter(counter_prefix + ".coalesced", 1)
+        return response
+
+    async def acall_with_cache(self, request_key: Optional[tuple],
+                               function: Callable[[], Awaitable[Any]],
+                               current_state: SearchState, counter_prefix: str) -> Any:
+        """
+        Async version of call_with_cache
+        """
+        self.record_concurrency_limit(current_state, counter_prefix)
+        if request_key is None:
+            return await function()
+        if self.cache is not None:
+            cache = self.cache
+
+            async def call():
+                return await cache.aget_or_call(request_key, function, current_state,
+                                                counter_prefix)
+        else:
+            call = function
+        if not self.coalesce_requests or get_batch_collector() is not None:
+            return await call()
+        response, is_shared = await request_coalescer.acall(request_key, call)
+        if is_shared:
+            current_state.update_counter(counter_prefix + ".coalesced", 1)
+        return response
+
     def extract_role_messages(self, input_str):
         # TODO Find a better way to handle JSON inputs
         if "\"role\": \"user\"" in input_str:
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+import threading
+import weakref
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Connection pool defaults for every provider/base URL
+DEFAULT_POOL_CONFIG = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30,
+}
+
+_clients: Dict[tuple, Any] = {}
+# async clients are bound to the event loop that they are used on
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, Any]]" = \
+    weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def build_limits(pool_config: Optional[Dict[str, Any]] = None):
+    """
+    :param pool_config: overrides for DEFAULT_POOL_CONFIG, i.e. max_connections,
+    max_keepalive_connections (idle connections kept alive) and keepalive_expiry (seconds)
+    :return: httpx.Limits for the connection pool
+    """
+    import httpx
+    return httpx.Limits(**(DEFAULT_POOL_CONFIG | (pool_config or {})))
+
+
+def _client_key(provider: str, base_url: Optional[str],
+                pool_config: Optional[Dict[str, Any]]) -> tuple:
+    return provider, base_url, json.dumps(pool_config or {}, sort_keys=True)
+
+
+def _get_or_create(key: tuple, create_fn, is_async: bool):
+    with _clients_lock:
+        if is_async:
+            clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+        else:
+            clients = _clients
+        if key not in clients:
+            logger.debug("Creating {}HTTP client for: {}".format("async " if is_async else "",
+                                                                 key))
+            clients[key] = create_fn()
+        return clients[key]
+
+
+def get_openai_client(base_url: Optional[str] = None,
+                      pool_config: Optional[Dict[str, Any]] = None):
+    """
+    Get the OpenAI client (and its connection pool) shared by all generators using the same base URL
+    and pool config in this process
+    """
+    from openai import DefaultHttpxClient, OpenAI
+
+    def create_client():
+        return OpenAI(base_url=base_url,
+                      http_client=DefaultHttpxClient(limits=build_limits(pool_config)))
+
+    return _get_or_create(_client_key("openai", base_url, pool_config), create_client,
+                          is_async=False)
+
+
+def get_async_openai_client(base_url: Optional[str] = None,
+                            pool_config: Optional[Dict[str, Any]] = None):
+    """
+    Get the AsyncOpenAI client shared by all generators using the same base URL and pool config on
+    the current event loop. Must be called from a coroutine.
+    """
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    def create_client():
+        return AsyncOpenAI(base_url=base_url,
+                           http_client=DefaultAsyncHttpxClient(limits=build_limits(pool_config)))
+
+    return _get_or_create(_client_key("openai", base_url, pool_config), create_client,
+                          is_async=True)
+
+
+def get_http_client(provider: str, pool_config: Optional[Dict[str, Any]] = None,
+                    timeout: float = 600):
+    """
+    Get the httpx client (connection pool) shared by all the generators for the provider
+    """
+    import httpx
+    return _get_or_create(_client_key(provider, None, pool_config),
+                          lambda: httpx.Client(limits=build_limits(pool_config), timeout=timeout),
+                          is_async=False)
+
+
+def get_async_http_client(provider: str, pool_config: Optional[Dict[str, Any]] = None,
+                          timeout: float = 600):
+    """
+    Get the async httpx client shared by all the generators for the provider on the current event
+    loop. Must be called from a coroutine.
+    """
+    import httpx
+    return _get_or_create(_client_key(provider, None, pool_config),
+                          lambda: httpx.AsyncClient(limits=build_limits(pool_config),
+                                                    timeout=timeout),
+                          is_async=True)
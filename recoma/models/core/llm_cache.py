@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from abc import abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from diskcache import Cache, FanoutCache, Timeout
+from diskcache.core import args_to_key
+
+from recoma.search.state import SearchState
+from recoma.utils.class_utils import RegistrableFromDict
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(namespace: str, ignore: Tuple[str, ...] = (), **kwargs) -> tuple:
+    """
+    Build the cache key for an LLM call with the given keyword arguments. Uses the same key format
+    as diskcache's memoize, so entries cached by a memoized function named namespace are re-used.
+    :param namespace: name to separate keys for different APIs
+    :param ignore: keyword arguments that should not be part of the key (e.g. API clients)
+    """
+    return args_to_key((namespace,), (), kwargs, False, set(ignore))
+
+
+class LLMCache(RegistrableFromDict):
+    """
+    Cache for LLM responses that can be shared by all the generators. Implementations must be safe
+    to use from multiple threads.
+    """
+
+    def __init__(self, track_bytes: bool = False, **kwargs):
+        """
+        :param track_bytes: also count the (pickled) size of the values read and written. Every
+        value is serialized to measure it, so this is off by default.
+        """
+        super().__init__(**kwargs)
+        self.track_bytes = track_bytes
+
+    @abstractmethod
+    def get(self, key: tuple) -> Optional[Any]:
+        """
+        :return: the cached value for the key or None if not present
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: tuple, value: Any):
+        raise NotImplementedError
+
+    async def aget(self, key: tuple) -> Optional[Any]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: tuple, value: Any):
+        await asyncio.to_thread(self.set, key, value)
+
+    def get_or_call(self, key: tuple, function: Callable[[], Any], state: SearchState,
+                    counter_prefix: str) -> Any:
+        """
+        Return the cached value for key, else call the function and cache its output. The cache
+        hit/miss (and bytes read/written if track_bytes is set) are added to the state counters
+        under counter_prefix.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.record(state, counter_prefix, value, is_hit=True)
+            return value
+        value = function()
+        self.set(key, value)
+        self.record(state, counter_prefix, value, is_hit=False)
+        return value
+
+    async def aget_or_call(self, key: tuple, function: Callable[[], Awaitable[Any]],
+                           state: SearchState, counter_prefix: str) -> Any:
+        """
+        Async version of get_or_call
+        """
+        value = await self.aget(key)
+        if value is not None:
+            self.record(state, counter_prefix, value, is_hit=True)
+            return value
+        value = await function()
+        await self.aset(key, value)
+        self.record(state, counter_prefix, value, is_hit=False)
+        return value
+
+    def record(self, state: SearchState, counter_prefix: str, value: Any, is_hit: bool):
+        state.update_counter(counter_prefix + (".cache_hit" if is_hit else ".cache_miss"), 1)
+        if not self.track_bytes:
+            return
+        try:
+            num_bytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            num_bytes = 0
+        state.update_counter(counter_prefix + (".cache_bytes_read" if is_hit else
+                                               ".cache_bytes_written"), num_bytes)
+
+
+@LLMCache.register("disk")
+class DiskLLMCache(LLMCache):
+    """
+    Disk cache backed by SQLite (via diskcache) that can be shared across threads and processes
+    """
+
+    def __init__(self, directory: str, size_limit: int = 2 ** 30,
+                 eviction_policy: str = "least-recently-stored", expire: Optional[float] = None,
+                 shards: int = 1, timeout: float = 60, **kwargs):
+        """
+        :param directory: cache directory
+        :param size_limit: approximate maximum size of the cache in bytes
+        :param eviction_policy: diskcache eviction policy used once the size limit is reached, e.g.
+        least-recently-stored, least-recently-used, least-frequently-used or none
+        :param expire: number of seconds after which entries expire (default: never)
+        :param shards: number of SQLite shards to reduce write contention with many writers. Note
+        that a sharded cache uses a different layout and does not read entries from an unsharded one
+        :param timeout: seconds to wait for the SQLite lock before treating the call as uncached
+        """
+        super().__init__(**kwargs)
+        self.directory = os.path.expanduser(directory)
+        self.expire = expire
+        if shards > 1:
+            self.cache = FanoutCache(self.directory, shards=shards, timeout=timeout,
+                                     size_limit=size_limit, eviction_policy=eviction_policy)
+        else:
+            self.cache = Cache(self.directory, timeout=timeout, size_limit=size_limit,
+                               eviction_policy=eviction_policy)
+
+    def get(self, key: tuple) -> Optional[Any]:
+        try:
+            return self.cache.get(key)
+        except Timeout:
+            logger.warning("Timed out reading from cache: {}".format(self.directory))
+            return None
+
+    def set(self, key: tuple, value: Any):
+        try:
+            self.cache.set(key, value, expire=self.expire)
+        except Timeout:
+            logger.warning("Timed out writing to cache: {}".format(self.directory))
+
+
+@LLMCache.register("memory")
+class MemoryLLMCache(LLMCache):
+    """
+    In-process LRU cache, e.g. to de-duplicate calls within a single run without touching disk
+    """
+
+    def __init__(self, max_entries: int = 10000, expire: Optional[float] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_entries = max_entries
+        self.expire = expire
+        # key -> (expiry time, value)
+        self._entries: "OrderedDict[tuple, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiry_time, value = entry
+            if expiry_time is not None and expiry_time < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: tuple, value: Any):
+        expiry_time = time.time() + self.expire if self.expire is not None else None
+        with self._lock:
+            self._entries[key] = (expiry_time, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget(self, key: tuple) -> Optional[Any]:
+        # no I/O, so no need for a worker thread
+        return self.get(key)
+
+    async def aset(self, key: tuple, value: Any):
+        self.set(key, value)
+
+
+_shared_caches: Dict[str, LLMCache] = {}
+_shared_caches_lock = threading.Lock()
+
+
+def get_shared_cache(cache_config: Dict[str, Any]) -> LLMCache:
+    """
+    Get the cache for this config. Generators with the same cache config share a single cache object
+    (and its connections) within a process.
+    """
+    config_key = json.dumps(cache_config, sort_keys=True)
+    with _shared_caches_lock:
+        if config_key not in _shared_caches:
+            _shared_caches[config_key] = LLMCache.from_dict(dict(cache_config))
+        return _shared_caches[config_key]
@@ -1,7 +1,13 @@
+import hashlib
+import json
 import logging
-from typing import Any
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Dict, Optional
 
-from jinja2 import Template
+from jinja2 import Environment, Template, TemplateSyntaxError, meta
 
 from recoma.models.core.base_model import BaseModel
 from recoma.models.core.generator import LMGenerator, GenerationOutputs
@@ -9,6 +15,88 @@ from recoma.search.state import SearchState
 
 logger = logging.getLogger(__name__)
 
+# The prefix is rendered separately from the rest of the prompt, so it must keep its trailing newline
+_prefix_environment = Environment(keep_trailing_newline=True)
+_input_str_marker = "{{ input_str }}"
+
+
+class CompiledPrompt:
+    """
+    Jinja template for a prompt, compiled once. If the prompt uses {{ input_str }} exactly once (and
+    the template can be split there), it is also compiled as a prefix template (e.g. few-shot
+    examples + example fields) that does not depend on the input_str and a suffix template. This
+    allows rendering the prefix once per example and only the suffix at every step.
+    """
+
+    def __init__(self, prompt: str):
+        self.template = Template(prompt)
+        self.prefix_template: Optional[Template] = None
+        self.suffix_template: Optional[Template] = None
+        self._verified = False
+        self._lock = threading.Lock()
+        if prompt.count("input_str") != 1 or _input_str_marker not in prompt:
+            return
+        split_idx = prompt.index(_input_str_marker)
+        try:
+            prefix_ast = _prefix_environment.parse(prompt[:split_idx])
+            # Only plain templates, i.e. no variables/macros defined in the prefix for the suffix
+            if any(tag in prompt[:split_idx] for tag in ["{% set", "{% macro", "{% import",
+                                                           "{% from", "{% extends", "{% block"]):
+                return
+            if "input_str" in meta.find_undeclared_variables(prefix_ast):
+                return
+            self.prefix_template = _prefix_environment.from_string(prompt[:split_idx])
+            self.suffix_template = Template(prompt[split_idx:])
+        except TemplateSyntaxError:
+            # e.g. {{ input_str }} within a for-loop
+            self.prefix_template = None
+            self.suffix_template = None
+
+    @property
+    def has_prefix(self) -> bool:
+        return self.prefix_template is not None
+
+    def render_prefix(self, template_params: Dict[str, Any]) -> Optional[str]:
+        """
+        Render the static prefix of this prompt.
+        :return: the rendered prefix or None if this prompt can not be split into a prefix
+        """
+        prefix_template = self.prefix_template
+        if prefix_template is None:
+            return None
+        prefix = prefix_template.render(template_params)
+        if not self._verified:
+            # Make sure the split rendering matches the full rendering before relying on it
+            with self._lock:
+                if not self._verified:
+                    full_output = self.template.render(template_params)
+                    if prefix + self.suffix_template.render(template_params) != full_output:
+                        logger.warning("Prompt can not be split at input_str. "
+                                       "Disabling prefix caching for this prompt.")
+                        self.prefix_template = None
+                        return None
+                    self._verified = True
+        return prefix
+
+
+_compiled_prompts: Dict[str, CompiledPrompt] = {}
+_compiled_prompts_lock = threading.Lock()
+
+
+def get_compiled_prompt(prompt: str) -> CompiledPrompt:
+    """
+    Get the compiled template for the prompt. Prompts are compiled once and shared across all the
+    models using the same prompt (e.g. the same prompt_file)
+    """
+    compiled_prompt = _compiled_prompts.get(prompt)
+    if compiled_prompt is None:
+        with _compiled_prompts_lock:
+            compiled_prompt = _compiled_prompts.get(prompt)
+            if compiled_prompt is None:
+                compiled_prompt = CompiledPrompt(prompt)
+                _compiled_prompts[prompt] = compiled_prompt
+    return compiled_prompt
+
 
 @BaseModel.register("prompted_lm")
 class PromptedLMModel(BaseModel):
@@ -20,7 +108,15 @@ class PromptedLMModel(BaseModel):
     output field for the current node and closed.
     """
 
-    def __init__(self, prompt_file: str, generator_params, **kwargs):
+    def __init__(self, prompt_file: str, generator_params, cache_prompt_prefix: bool = True,
+                 max_cached_prefixes: int = 256, **kwargs):
+        """
+        :param prompt_file: file with the Jinja prompt template
+        :param generator_params: config for the LMGenerator
+        :param cache_prompt_prefix: render the part of the prompt before {{ input_str }} once per
+        example and re-use it for every step of the example
+        :param max_cached_prefixes: max number of rendered prefixes (i.e. examples) cached
+        """
         super().__init__(**kwargs)
         if prompt_file:
             with open(prompt_file, "r") as input_fp:
@@ -28,15 +124,79 @@ class PromptedLMModel(BaseModel):
         else:
             self.prompt = ""
         self.generator = LMGenerator.from_dict(generator_params)
+        # The prefix can only be cached if it only depends on the example
+        self.cache_prompt_prefix = cache_prompt_prefix and (
+                type(self).populate_template_dictionary is
+                PromptedLMModel.populate_template_dictionary)
+        self.max_cached_prefixes = max_cached_prefixes
+        # (example id, prompt id) -> (weak reference to the example, rendered prefix)
+        self._prefix_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._prefix_cache_lock = threading.Lock()
+
+    def can_memoize(self) -> bool:
+        # sampled outputs should not be re-used and the prompt must only depend on the example and
+        # the input string (the memo key)
+        params = self.generator.generator_params
+        return params.temperature == 0 and params.num_sequences == 1 and (
+                type(self).populate_template_dictionary is
+                PromptedLMModel.populate_template_dictionary)
+
+    def cache_fingerprint(self) -> str:
+        # outputs change with the prompt, the LM or the generation params
+        return hashlib.sha1(json.dumps(
+            [type(self).__name__, self.prompt, type(self.generator).__name__,
+             getattr(self.generator, "model", None), asdict(self.generator.generator_params)],
+            sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
     def build_lm_input(self, prompt: str, input_str: str, state: SearchState) -> str:
         """
         Generate the language model input given the prompt, input string and search state.
         :return: language model input string
         """
-        template = Template(prompt)
+        compiled_prompt = get_compiled_prompt(prompt)
         template_params = self.populate_template_dictionary(input_str, state)
-        return template.render(template_params)
+        if not self.cache_prompt_prefix or not compiled_prompt.has_prefix:
+            return compiled_prompt.template.render(template_params)
+        prefix = self.get_cached_prefix(compiled_prompt, state.example)
+        if prefix is None:
+            prefix = compiled_prompt.render_prefix(template_params)
+            if prefix is None:
+                return compiled_prompt.template.render(template_params)
+            self.set_cached_prefix(compiled_prompt, state.example, prefix)
+        return prefix + compiled_prompt.suffix_template.render(template_params)
+
+    def get_prompt_prefix(self, lm_input: str, state: SearchState) -> Optional[str]:
+        """
+        :return: the cached prefix of the LM input (shared by all the steps of the example), if any
+        """
+        if not self.cache_prompt_prefix:
+            return None
+        prefix = self.get_cached_prefix(get_compiled_prompt(self.prompt), state.example)
+        if prefix is None or not lm_input.startswith(prefix):
+            return None
+        return prefix
+
+    def get_cached_prefix(self, compiled_prompt: CompiledPrompt, example) -> Optional[str]:
+        key = (id(example), id(compiled_prompt))
+        with self._prefix_cache_lock:
+            cached = self._prefix_cache.get(key)
+            if cached is None:
+                return None
+            example_ref, prefix = cached
+            if example_ref() is not example:
+                # a different example re-used the id of a deleted example
+                del self._prefix_cache[key]
+                return None
+            self._prefix_cache.move_to_end(key)
+            return prefix
+
+    def set_cached_prefix(self, compiled_prompt: CompiledPrompt, example, prefix: str):
+        key = (id(example), id(compiled_prompt))
+        with self._prefix_cache_lock:
+            self._prefix_cache[key] = (weakref.ref(example), prefix)
+            self._prefix_cache.move_to_end(key)
+            while len(self._prefix_cache) > self.max_cached_prefixes:
+                self._prefix_cache.popitem(last=False)
 
     def populate_template_dictionary(self, input_str: str, state: SearchState) -> dict[str, Any]:
         """
@@ -66,5 +226,22 @@ class PromptedLMModel(BaseModel):
         output = self.generator.generate(lm_input, state)
         logger.debug("Input: ..." + lm_input[-200:])
         logger.debug("Output: " + output.outputs[0])
-        open_node.add_input_output_prompt(lm_input, output)
+        open_node.add_input_output_prompt(lm_input, output,
+                                          prefix=self.get_prompt_prefix(lm_input, state))
+        return output
+
+    async def agenerate_output(self, state) -> GenerationOutputs:
+        """
+        Async version of generate_output that uses the async generator API
+        :return: generator outputs
+        """
+        open_node = state.get_open_node()
+        if open_node is None:
+            raise ValueError("Model called without any open node!!")
+        lm_input = self.build_lm_input(self.prompt, open_node.input_str, state)
+        output = await self.generator.agenerate(lm_input, state)
+        logger.debug("Input: ..." + lm_input[-200:])
+        logger.debug("Output: " + output.outputs[0])
+        open_node.add_input_output_prompt(lm_input, output,
+                                          prefix=self.get_prompt_prefix(lm_input, state))
         return output
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter with a request budget (requests_per_minute) and a token budget
+    (tokens_per_minute). Each bucket holds up to a minute of budget and refills continuously.
+    Callers reserve their request/tokens up front (the bucket level can go negative) and wait until
+    the level would be non-negative again, so callers are admitted in order without busy waiting.
+    The token reservation is an estimate that should be corrected with the actual usage once known.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._last_refill = time.monotonic()
+        self._request_level = requests_per_minute or 0
+        self._token_level = tokens_per_minute or 0
+
+    def _refill(self, current_time: float):
+        elapsed = current_time - self._last_refill
+        self._last_refill = current_time
+        if self.requests_per_minute:
+            self._request_level = min(self.requests_per_minute,
+                                      self._request_level + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_level = min(self.tokens_per_minute,
+                                    self._token_level + elapsed * self.tokens_per_minute / 60)
+
+    def _reserve(self, num_tokens: int) -> float:
+        """
+        Reserve one request and num_tokens tokens
+        :return: seconds to wait before the reservation can be used
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait_time = 0.0
+            if self.requests_per_minute:
+                self._request_level -= 1
+                if self._request_level < 0:
+                    wait_time = -self._request_level * 60 / self.requests_per_minute
+            if self.tokens_per_minute:
+                self._token_level -= num_tokens
+                if self._token_level < 0:
+                    wait_time = max(wait_time, -self._token_level * 60 / self.tokens_per_minute)
+            return wait_time
+
+    def _cancel(self, num_tokens: int):
+        with self._lock:
+            if self.requests_per_minute:
+                self._request_level += 1
+            if self.tokens_per_minute:
+                self._token_level += num_tokens
+
+    def acquire(self, num_tokens: int) -> float:
+        """
+        Block until a request with (an estimated) num_tokens tokens can be sent
+        :return: seconds spent waiting
+        """
+        wait_time = self._reserve(num_tokens)
+        if wait_time > 0:
+            logger.debug("Rate limited. Waiting {:.2f}s".format(wait_time))
+            time.sleep(wait_time)
+        return wait_time
+
+    async def aacquire(self, num_tokens: int) -> float:
+        """
+        Async version of acquire
+        """
+        wait_time = self._reserve(num_tokens)
+        if wait_time > 0:
+            logger.debug("Rate limited. Waiting {:.2f}s".format(wait_time))
+            try:
+                await asyncio.sleep(wait_time)
+            except asyncio.CancelledError:
+                # Give back the reservation for a request that was never sent
+                self._cancel(num_tokens)
+                raise
+        return wait_time
+
+    def correct(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the token reservation once the actual usage of a request is known
+        """
+        if self.tokens_per_minute:
+            with self._lock:
+                self._token_level = min(self.tokens_per_minute,
+                                        self._token_level + estimated_tokens - actual_tokens)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str, requests_per_minute: Optional[float] = None,
+                     tokens_per_minute: Optional[float] = None) -> RateLimiter:
+    """
+    Get the rate limiter for the name (e.g. model). All the generators using the same model share
+    the same quota and hence the same limiter. The budgets from the first call are used.
+    """
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(name)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(requests_per_minute=requests_per_minute,
+                                       tokens_per_minute=tokens_per_minute)
+            _rate_limiters[name] = rate_limiter
+        elif (rate_limiter.requests_per_minute != requests_per_minute or
+              rate_limiter.tokens_per_minute != tokens_per_minute):
+            logger.warning("Rate limiter for {} already exists with requests_per_minute={} and "
+                           "tokens_per_minute={}. Ignoring the new budgets.".format(
+                            name, rate_limiter.requests_per_minute,
+                            rate_limiter.tokens_per_minute))
+        return rate_limiter
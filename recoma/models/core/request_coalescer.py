@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from recoma.search.deadline import DeadlineExceeded, check_deadline, remaining_time
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+
+
+class RequestCoalescer:
+    """
+    Single-flight de-duplication of identical requests: while a request with a given key is in
+    flight, concurrent callers with the same key wait for it and share its result (or exception)
+    instead of issuing their own request. Only requests that are expected to return the same output
+    (e.g. greedy decoding) should be coalesced.
+    Failures that are specific to the caller making the shared call, i.e. its deadline or its
+    cancellation, are not shared: one of the waiting callers makes the call instead. Waiting callers
+    stop waiting when their own deadline is reached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _InFlightCall] = {}
+        # (event loop id, key) -> future, since futures can only be awaited on their own loop
+        self._futures: Dict[Tuple[int, Hashable], asyncio.Future] = {}
+
+    def call(self, key: Hashable, function: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Call the function unless an identical call (same key) is already in flight, in which case
+        wait for it and return its result.
+        :return: the result and whether it was shared from another in-flight call
+        """
+        while True:
+            with self._lock:
+                in_flight = self._calls.get(key)
+                if in_flight is None:
+                    in_flight = _InFlightCall()
+                    self._calls[key] = in_flight
+                    break
+            check_deadline()
+            timeout = remaining_time()
+            if not in_flight.done.wait(None if timeout is None else max(timeout, 0)):
+                # the deadline of this caller was reached while waiting
+                check_deadline()
+                continue
+            if in_flight.exception is None:
+                return in_flight.result, True
+            if not self.is_caller_specific(in_flight.exception):
+                raise in_flight.exception
+            # the shared call failed because of its caller, so make the call again
+        try:
+            in_flight.result = function()
+            return in_flight.result, False
+        except BaseException as e:
+            in_flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            in_flight.done.set()
+
+    async def acall(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Async version of call. If the task making the shared call is cancelled (or reaches its
+        deadline), one of the waiting tasks makes the call instead.
+        """
+        loop = asyncio.get_running_loop()
+        future_key = (id(loop), key)
+        while True:
+            future = self._futures.get(future_key)
+            if future is None:
+                break
+            check_deadline()
+            try:
+                # shield so that cancelling one waiting task does not cancel the shared call
+                return await asyncio.wait_for(asyncio.shield(future), remaining_time()), True
+            except asyncio.TimeoutError:
+                # the deadline of this task was reached while waiting (or the shared call timed out)
+                check_deadline()
+                raise
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # this task was cancelled
+                    raise
+        future = loop.create_future()
+        self._futures[future_key] = future
+        try:
+            result = await function()
+            future.set_result(result)
+            return result, False
+        except (asyncio.CancelledError, DeadlineExceeded):
+            # not shared with the waiting tasks, one of them makes the call instead
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark the exception as retrieved if there are no waiting tasks
+            future.exception()
+            raise
+        finally:
+            del self._futures[future_key]
+
+    @staticmethod
+    def is_caller_specific(exception: BaseException) -> bool:
+        """
+        Did the shared call fail because of its caller (deadline, cancellation or interrupt) rather
+        than the request itself?
+        """
+        return isinstance(exception, DeadlineExceeded) or not isinstance(exception, Exception)
+
+
+# Shared by all the models so that identical requests from different examples are coalesced
+request_coalescer = RequestCoalescer()
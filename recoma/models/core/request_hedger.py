@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RequestHedger:
+    """
+    Hedges slow requests: if a request has not returned within the given percentile of the recently
+    observed latencies, a duplicate request is sent and the first successful response is used. The
+    number of hedged requests is capped to a fraction (budget) of all the requests.
+
+    The function passed to call/acall should be the raw provider call (i.e. already admitted by
+    any rate limiter), so that only the provider latency is observed. In the async version, the
+    slower request is cancelled. Threads can not be interrupted though, so in the sync version the
+    slower request still runs to completion (and is billed by the provider) on one of the
+    max_threads hedging threads and its response is dropped.
+    """
+
+    def __init__(self, percentile: float = 95, min_samples: int = 20, window: int = 500,
+                 budget: float = 0.05, min_delay: float = 0.0, max_threads: int = 16, **kwargs):
+        """
+        :param percentile: hedge requests slower than this percentile of recent latencies
+        :param min_samples: min number of observed latencies before hedging
+        :param window: number of recent latencies to compute the percentile over
+        :param budget: max fraction of the requests that can be hedged
+        :param min_delay: min seconds to wait before hedging
+        :param max_threads: max number of threads for the sync requests that may be hedged
+        (including the slower requests still running after a hedge won). Requests are sent
+        without hedging when all the threads are busy.
+        """
+        if kwargs:
+            logger.warning("Ignoring unknown hedging params: {}".format(kwargs))
+        if max_threads < 2:
+            raise ValueError("Hedging needs max_threads >= 2: {}".format(max_threads))
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.min_delay = min_delay
+        self.max_threads = max_threads
+        self._latencies: deque = deque(maxlen=window)
+        self._num_calls = 0
+        self._num_hedges = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # free threads of the executor, so that submitted requests never wait in its queue
+        self._thread_slots = threading.BoundedSemaphore(max_threads)
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        :return: seconds after which a request should be hedged or None if there are not enough
+        latency samples yet
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return max(self.min_delay, latencies[max(0, index)])
+
+    def _start_call(self):
+        with self._lock:
+            self._num_calls += 1
+
+    def _start_hedge(self) -> bool:
+        with self._lock:
+            if self._num_hedges + 1 > self.budget * self._num_calls:
+                return False
+            self._num_hedges += 1
+            return True
+
+    def _submit(self, function: Callable[[], Any], is_hedge: bool = False) -> Optional[Future]:
+        """
+        Run the (timed) function on a hedging thread
+        :param is_hedge: only submit if the hedging budget allows it
+        :return: the future or None if no thread (or hedging budget) is available
+        """
+        if not self._thread_slots.acquire(blocking=False):
+            return None
+        if is_hedge and not self._start_hedge():
+            self._thread_slots.release()
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_threads,
+                                                    thread_name_prefix="hedge")
+        future = self._executor.submit(self._timed, function)
+        future.add_done_callback(lambda _: self._thread_slots.release())
+        return future
+
+    def _record_latency(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _timed(self, function: Callable[[], Any]) -> Any:
+        start_time = time.monotonic()
+        result = function()
+        self._record_latency(time.monotonic() - start_time)
+        return result
+
+    async def _atimed(self, function: Callable[[], Awaitable[Any]]) -> Any:
+        start_time = time.monotonic()
+        result = await function()
+        self._record_latency(time.monotonic() - start_time)
+        return result
+
+    def call(self, function: Callable[[], Any]) -> Tuple[Any, bool, bool]:
+        """
+        Call function, hedging it with a second call if it is slow
+        :return: the result, whether the call was hedged and whether the hedge won
+        """
+        self._start_call()
+        delay = self.hedge_delay()
+        primary = None if delay is None else self._submit(function)
+        if primary is None:
+            return self._timed(function), False, False
+        done, _ = wait([primary], timeout=delay)
+        hedge = None if done else self._submit(function, is_hedge=True)
+        if hedge is None:
+            return primary.result(), False, False
+        logger.debug("Hedging request after {:.2f}s".format(delay))
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the other request can not be interrupted: it runs to completion on its
+                    # thread and its result is dropped
+                    return future.result(), True, future is hedge
+            if not pending:
+                # both failed
+                return primary.result(), True, False
+
+    async def acall(self, function: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool, bool]:
+        """
+        Async version of call. The slower request is cancelled.
+        """
+        self._start_call()
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._atimed(function), False, False
+        primary = asyncio.ensure_future(self._atimed(function))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._start_hedge():
+                return await primary, False, False
+            logger.debug("Hedging request after {:.2f}s".format(delay))
+            hedge = asyncio.ensure_future(self._atimed(function))
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), True, task is hedge
+                if not pending:
+                    return await primary, True, False
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+
+_hedgers: Dict[str, RequestHedger] = {}
+_hedgers_lock = threading.Lock()
+
+
+def get_request_hedger(name: str, **kwargs) -> RequestHedger:
+    """
+    Get the request hedger for the name (e.g. model) so that the latencies and hedging budget are
+    shared by all generators for the same model. The params from the first call are used.
+    """
+    with _hedgers_lock:
+        if name not in _hedgers:
+            _hedgers[name] = RequestHedger(**kwargs)
+        return _hedgers[name]
@@ -0,0 +1,105 @@
+import asyncio
+import email.utils
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+RETRYABLE = "retryable"
+FATAL = "fatal"
+UNKNOWN = "unknown"
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+# Errors that will never succeed on retry, e.g. invalid requests, auth failures, inputs that
+# exceed the context length or a search that ran out of time
+FATAL_ERROR_NAMES = ["BadRequest", "Authentication", "PermissionDenied", "NotFound",
+                     "UnprocessableEntity", "InvalidRequest", "ContextWindowExceeded",
+                     "ContentPolicyViolation", "UnsupportedParams", "DeadlineExceeded"]
+RETRYABLE_ERROR_NAMES = ["RateLimit", "Timeout", "APIConnection", "ServiceUnavailable",
+                         "InternalServer", "ConnectError", "ReadError", "RemoteProtocol"]
+CONTEXT_OVERFLOW_MESSAGES = ["context length", "context window", "maximum context"]
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Classify an API error as RETRYABLE (rate limits, server errors, timeouts, connection errors),
+    FATAL (invalid requests, auth errors, context overflow) or UNKNOWN
+    """
+    error_name = type(error).__name__
+    if any(name in error_name for name in FATAL_ERROR_NAMES):
+        return FATAL
+    if any(name in error_name for name in RETRYABLE_ERROR_NAMES):
+        return RETRYABLE
+    if any(message in str(error).lower() for message in CONTEXT_OVERFLOW_MESSAGES):
+        return FATAL
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return RETRYABLE
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        if status_code in RETRYABLE_STATUS_CODES or status_code >= 500:
+            return RETRYABLE
+        if 400 <= status_code < 500:
+            return FATAL
+    return UNKNOWN
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """
+    Seconds to wait before retrying as requested by the server via the Retry-After (or
+    retry-after-ms) header of the error response, if any
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        headers = getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP date
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_date.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    # max number of attempts (including the first call)
+    max_attempts: int = 10
+    # min/max wait between attempts for the randomized exponential backoff
+    min_wait: float = 1
+    max_wait: float = 60
+    # stop retrying once this many seconds have been spent on a call (None = no limit)
+    max_retry_time: Optional[float] = None
+    # retry errors that are neither known to be retryable nor fatal
+    retry_unknown_errors: bool = True
+
+    def get_wait_time(self, error: BaseException, attempt: int,
+                      elapsed_time: float) -> Optional[float]:
+        """
+        Decide whether to retry after the error
+        :param error: error raised by the attempt
+        :param attempt: number of attempts made so far (starting at 1)
+        :param elapsed_time: seconds spent on this call so far
+        :return: seconds to wait before the next attempt or None if the error should be raised
+        """
+        error_class = classify_error(error)
+        if error_class == FATAL or (error_class == UNKNOWN and not self.retry_unknown_errors):
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        wait_time = get_retry_after(error)
+        if wait_time is None:
+            wait_time = min(self.max_wait,
+                            max(self.min_wait, random.uniform(0, self.min_wait * 2 ** attempt)))
+        if self.max_retry_time is not None and elapsed_time + wait_time > self.max_retry_time:
+            return None
+        return wait_time
@@ -24,6 +24,9 @@ class RegexExtractor(BaseModel):
         super().__init__(**kwargs)
         self.regex = re.compile(regex)
 
+    def can_memoize(self) -> bool:
+        return True
+
     def generate_output(self, state):
         open_node = state.get_open_node()
         if open_node is None:
@@ -51,8 +54,11 @@ class RouterModel(BaseModel):
         super().__init__(**kwargs)
         self.regex = re.compile(regex)
 
+    def can_memoize(self) -> bool:
+        return True
+
     def __call__(self, state: SearchState) -> List[SearchState]:
-        new_state = state.clone(deep=True)
+        new_state = state.clone()
         current_node = new_state.get_open_node()
         if current_node is None:
             raise ValueError("Model called without any open node!!")
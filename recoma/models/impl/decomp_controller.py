@@ -13,8 +13,11 @@ class DecompController(BaseModel):
         self.decomp_model = decomp_model
         self.qa_model = qa_model
 
+    def can_memoize(self) -> bool:
+        return True
+
     def __call__(self, state: SearchState):
-        new_state = state.clone(deep=True)
+        new_state = state.clone()
         current_node = new_state.get_open_node()
         if current_node is None:
             raise ValueError("Model called without any open node!!")
@@ -17,6 +17,9 @@ class LeastToMostController(BaseModel):
         self.l2m_decomp_model = l2m_decomp_model
         self.l2m_qa_model = l2m_qa_model
 
+    def can_memoize(self) -> bool:
+        return True
+
     def parse_decomposition(self, gen_output):
         re_match = self.step_regex.match(gen_output)
         if re_match:
@@ -32,7 +35,7 @@ class LeastToMostController(BaseModel):
         return []
 
     def __call__(self, state: SearchState):
-        new_state = state.clone(deep=True)
+        new_state = state.clone()
         current_node = new_state.get_open_node()
         if current_node is None:
             raise ValueError("Model called without any open node!!")
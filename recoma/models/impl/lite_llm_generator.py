@@ -1,43 +1,56 @@
 import logging
-import os
-from typing import Any
 import json
+import threading
+from typing import Any, Dict, Optional
+
 import litellm
-from diskcache import Cache
-from litellm import completion, completion_cost
-from tenacity import (before_sleep_log, retry,  # for exponential backoff
-                      stop_after_attempt, wait_random_exponential)
+from litellm import acompletion, completion, completion_cost
 
 from recoma.models.core.generator import GenerationOutputs, LMGenerator
+from recoma.models.core.http_clients import get_async_http_client, get_http_client
+from recoma.models.core.llm_cache import get_shared_cache, make_cache_key
 
 logger = logging.getLogger(__name__)
 
 litellm.drop_params = True
 
-cache = Cache(os.path.expanduser("~/.cache/litellmcalls"))
-
-
-cache_hit = True
-
-@cache.memoize()
-def cached_litellm_call(
-        model, messages, temperature, max_tokens, top_p, logprobs, top_logprobs,
-        frequency_penalty, presence_penalty, stop, n, seed, response_format
-):
-    global cache_hit
-    cache_hit = False
-    return completion(model=model, messages=messages,
-                      temperature=temperature,
-                      max_tokens=max_tokens,
-                      top_p=top_p,
-                      logprobs=logprobs,
-                      top_logprobs=top_logprobs,
-                      n=n,
-                      stop=stop,
-                      seed=seed,
-                      frequency_penalty=frequency_penalty,
-                      presence_penalty=presence_penalty,
-                      response_format=response_format)
+# Same name as the earlier memoized cache function so that existing cache entries are re-used
+CACHE_NAMESPACE = "recoma.models.impl.lite_llm_generator.cached_litellm_call"
+DEFAULT_CACHE_CONFIG = {"type": "disk", "directory": "~/.cache/litellmcalls"}
+
+# Marker for the HTTP sessions of litellm not being set yet
+_UNSET = object()
+# litellm only has process-wide HTTP sessions (used for the OpenAI-compatible providers), so every
+# LiteLLM generator shares the connection pool configured by the first one
+_session_pool_config: Any = _UNSET
+_session_lock = threading.Lock()
+
+
+def set_litellm_session(pool_config: Optional[Dict[str, Any]]):
+    """
+    Set the process-wide HTTP session of litellm for the pool config, unless it has already been
+    set (by an earlier generator)
+    """
+    global _session_pool_config
+    with _session_lock:
+        if _session_pool_config is _UNSET:
+            _session_pool_config = pool_config
+            litellm.client_session = get_http_client("litellm", pool_config=pool_config)
+        elif _session_pool_config != pool_config:
+            logger.warning("litellm uses one HTTP connection pool per process. Ignoring http_pool: "
+                           "{} (using: {})".format(pool_config, _session_pool_config))
+
+
+def set_litellm_async_session():
+    """
+    Set the async HTTP session of litellm for the current event loop (async clients are bound to
+    the loop that they are used on). Must be called from a coroutine.
+    """
+    pool_config = None if _session_pool_config is _UNSET else _session_pool_config
+    client = get_async_http_client("litellm", pool_config=pool_config)
+    # only replaced when the event loop changes
+    if litellm.aclient_session is not client:
+        litellm.aclient_session = client
 
 
 @LMGenerator.register("lite_llm")
@@ -45,39 +58,57 @@ class LiteLLMGenerator(LMGenerator):
 
     def __init__(self, model: str, use_cache: bool=False, **kwargs):
         super().__init__(**kwargs)
-        self.use_cache = use_cache
+        if use_cache and self.cache is None:
+            self.cache = get_shared_cache(DEFAULT_CACHE_CONFIG)
+        self.use_cache = self.cache is not None
         self.model = model
+        set_litellm_session(self.http_pool)
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(10),
-           before_sleep=before_sleep_log(logger, logging.DEBUG))
-    def completion_with_backoff(self, function, **kwargs) -> dict[Any, Any]:
-        return function(**kwargs)
+    def request_key(self, generator_args):
+        # Only greedy requests are cached and coalesced
+        if self.generator_params.temperature != 0:
+            return None
+        return make_cache_key(CACHE_NAMESPACE, **generator_args)
 
-    def generate(self, input_str, state):
+    def build_generator_args(self, input_str):
         messages_json = self.extract_role_messages(input_str)
         formatted_messages = json.dumps(messages_json, indent=2)
         logger.debug("Messages:\n{}\n...\n{}".format(formatted_messages[:200], formatted_messages[-200:]))
         generator_args = self.generator_params_to_args(self.generator_params)
         generator_args["messages"] = messages_json
         generator_args["model"] = self.model
-        global cache_hit
-        if self.use_cache and self.generator_params.temperature == 0:
-            cache_hit = True
-            function = cached_litellm_call
-        else:
-            cache_hit = False
-            function = completion
+        return generator_args
+
+    def generate(self, input_str, state):
+        generator_args = self.build_generator_args(input_str)
+
+        def call_api():
+            return self.call_with_retries(completion, state, "litellm." + self.model,
+                                          **generator_args)
+
+        response = self.call_with_cache(self.request_key(generator_args), call_api, state,
+                                        "litellm." + self.model)
+        return self.process_response(response, generator_args["messages"], state)
+
+    async def agenerate(self, input_str, state):
+        generator_args = self.build_generator_args(input_str)
+        set_litellm_async_session()
+
+        async def call_api():
+            return await self.acall_with_retries(acompletion, state, "litellm." + self.model,
+                                                 **generator_args)
 
-        response = self.completion_with_backoff(function=function, **generator_args)
+        response = await self.acall_with_cache(self.request_key(generator_args), call_api, state,
+                                               "litellm." + self.model)
+        return self.process_response(response, generator_args["messages"], state)
 
+    def process_response(self, response, messages_json, state):
         try:
             cost = completion_cost(response)
             state.update_counter("litellm.{}.cost".format(self.model), cost)
         except:
             # Unknown model
             pass
-        if cache_hit:
-            state.update_counter("litellm.{}.cache_hit".format(self.model), 1)
         state.update_counter("litellm.{}.calls".format(self.model), 1)
 
         for usage_key in ["completion_tokens", "prompt_tokens", "total_tokens"]:
@@ -101,6 +132,7 @@ class LiteLLMGenerator(LMGenerator):
         # JSON Formatted message, add to node
         if len(messages_json) > 1:
             open_node = state.get_open_node()
-            open_node.add_input_output_prompt(formatted_messages, generation_outputs)
+            open_node.add_input_output_prompt(json.dumps(messages_json, indent=2),
+                                              generation_outputs)
 
         return generation_outputs
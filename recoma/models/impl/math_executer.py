@@ -6,6 +6,7 @@ from sympy import solve
 
 from recoma.models.core.base_model import BaseModel
 from recoma.models.core.generator import GenerationOutputs
+from recoma.models.core.request_coalescer import request_coalescer
 from recoma.search.state import SearchState
 
 logger = logging.getLogger(__name__)
@@ -36,7 +37,11 @@ class MathProgramExecuter(BaseModel):
         if curr_node is None:
             raise ValueError("Model called without any open node!!")
         input_prog = curr_node.input_str
-        output = self.eval_program(input_prog)
+        # identical programs from concurrent examples are only executed once
+        output, is_shared = request_coalescer.call(("math_exec", input_prog),
+                                                   lambda: self.eval_program(input_prog))
+        if is_shared:
+            state.update_counter("math_exec.coalesced", 1)
         curr_node.input_str = "```\n" + curr_node.input_str + "\n```"
         return GenerationOutputs(outputs=[output])
 
@@ -1,88 +1,94 @@
 import json
 import logging
-import os
+from typing import Optional
+
 from litellm import completion_cost
 
 from openai.types.chat.chat_completion import ChatCompletion
-from diskcache import Cache
-from tenacity import (before_sleep_log, retry,  # for exponential backoff
-                      stop_after_attempt, wait_random_exponential)
 
 from recoma.models.core.generator import GenerationOutputs, LMGenerator
+from recoma.models.core.http_clients import get_async_openai_client, get_openai_client
+from recoma.models.core.llm_cache import get_shared_cache, make_cache_key
 from recoma.search.state import SearchState
 
 logger = logging.getLogger(__name__)
 
-cache = Cache(os.path.expanduser("~/.cache/gpt3calls"))
-cache_hit = True
-
-@cache.memoize(ignore=("client"))
-def cached_openai_chat_call(
-        client, model, messages, temperature, max_tokens, top_p, logprobs, top_logprobs,
-        frequency_penalty, presence_penalty, stop, n, seed, response_format
-):
-    global cache_hit
-    cache_hit = False
-    return client.chat.completions.create(model=model, messages=messages,
-                                          temperature=temperature,
-                                          max_tokens=max_tokens,
-                                          top_p=top_p,
-                                          logprobs=logprobs,
-                                          top_logprobs=top_logprobs,
-                                          n=n,
-                                          stop=stop,
-                                          seed=seed,
-                                          frequency_penalty=frequency_penalty,
-                                          presence_penalty=presence_penalty,
-                                          response_format=response_format)
+# Same name as the earlier memoized cache function so that existing cache entries are re-used
+CACHE_NAMESPACE = "recoma.models.impl.openai_generators.cached_openai_chat_call"
+DEFAULT_CACHE_CONFIG = {"type": "disk", "directory": "~/.cache/gpt3calls"}
 
 
 @LMGenerator.register("openai_chat")
 class OpenAIChatGenerator(LMGenerator):
+    supports_batch_api = True
 
-    def __init__(self, model: str, use_cache=False, **kwargs):
+    def __init__(self, model: str, use_cache=False, base_url: Optional[str] = None, **kwargs):
         super().__init__(**kwargs)
-        from openai import OpenAI
-        self.client = OpenAI()
+        self.base_url = base_url
+        # Shared with all the generators using the same base_url
+        self.client = get_openai_client(base_url=base_url, pool_config=self.http_pool)
         self.model = model
-        self.use_cache = use_cache
+        if use_cache and self.cache is None:
+            self.cache = get_shared_cache(DEFAULT_CACHE_CONFIG)
+        self.use_cache = self.cache is not None
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(10),
-           before_sleep=before_sleep_log(logger, logging.DEBUG))
-    def completion_with_backoff(self, function, **kwargs) -> ChatCompletion:
-        return function(**kwargs)
+    @property
+    def async_client(self):
+        # Created lazily (per event loop) since most runs only use the synchronous client
+        return get_async_openai_client(base_url=self.base_url, pool_config=self.http_pool)
 
-    def generate(self, input_str, state: SearchState):
+    def request_key(self, generator_args):
+        # Only greedy requests are cached and coalesced (o1 models always sample)
+        if self.generator_params.temperature != 0 or "o1" in self.model:
+            return None
+        # The earlier cache keys ignored "n", so only add it to the key when it can change the
+        # response to keep the existing single-sequence entries valid
+        ignore = ("n",) if generator_args.get("n", 1) == 1 else ()
+        return make_cache_key(CACHE_NAMESPACE, ignore=ignore, **generator_args)
+
+    def build_generator_args(self, input_str):
         messages_json = self.extract_role_messages(input_str)
         logger.debug("Messages:\n{}".format(json.dumps(messages_json, indent=2)[:100]))
         generator_args = self.generator_params_to_args(self.generator_params)
         generator_args["messages"] = messages_json
         generator_args["model"] = self.model
 
-        global cache_hit
-        if self.use_cache and self.generator_params.temperature == 0 and "o1" not in self.model:
-            function = cached_openai_chat_call
-            generator_args["client"] = self.client
-            cache_hit = True
-        else:
-            cache_hit = False
-            function = self.client.chat.completions.create
-
         if "o1" in self.model:
             # Change argeument to max_completion_tokens, set temperature to 1.0, and remove stop
             generator_args["max_completion_tokens"] = generator_args.pop("max_tokens")
             generator_args["temperature"] = 1.0
             generator_args.pop("stop")
+        return generator_args
+
+    def generate(self, input_str, state: SearchState):
+        generator_args = self.build_generator_args(input_str)
+
+        def call_api():
+            return self.call_with_retries(self.client.chat.completions.create, state,
+                                          "openai." + self.model, **generator_args)
+
+        response: ChatCompletion = self.call_with_cache(self.request_key(generator_args), call_api,
+                                                        state, "openai." + self.model)
+        return self.process_response(response, state)
+
+    async def agenerate(self, input_str, state: SearchState):
+        generator_args = self.build_generator_args(input_str)
+
+        async def call_api():
+            return await self.acall_with_retries(self.async_client.chat.completions.create, state,
+                                                 "openai." + self.model, **generator_args)
+
+        response: ChatCompletion = await self.acall_with_cache(
+            self.request_key(generator_args), call_api, state, "openai." + self.model)
+        return self.process_response(response, state)
 
-        response: ChatCompletion = self.completion_with_backoff(function=function, **generator_args)
+    def process_response(self, response: ChatCompletion, state: SearchState):
         try:
             cost = completion_cost(response)
             state.update_counter("openai.{}.cost".format(self.model), cost)
         except:
             # Unknown model
             pass
-        if cache_hit:
-            state.update_counter("openai.{}.cache_hit".format(self.model), 1)
         generation_outputs = GenerationOutputs(outputs=[], scores=[])
         state.update_counter("openai.{}.calls".format(self.model), 1)
         for usage_key, count in response.usage.__dict__.items():
@@ -1,19 +1,27 @@
 import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import itertools
 import json
 import logging
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, Iterable, List
 
 import _jsonnet
 import gradio as gr
 
-from recoma.datasets.reader import DatasetReader, QAExample
+from recoma.datasets.reader import DatasetReader, Example, QAExample
 from recoma.models.core.base_model import BaseModel
+from recoma.models.core.batch_backend import BatchBackend
+from recoma.search.batch_driver import BatchSearchDriver
 from recoma.search.search import SearchAlgo, ExamplePrediction
 from recoma.utils.class_utils import import_module_and_submodules
 from recoma.utils.env_utils import get_environment_variables
+from recoma.utils.prediction_writer import PredictionWriter
 from recoma.utils.state_renderer import StateRenderer
 
 logger = logging.getLogger(__name__)
@@ -43,6 +51,33 @@ def parse_arguments():
                             help="Dump input prompts -> output in output directory.")
     arg_parser.add_argument("--include-package", type=str, action="append", default=[],
                             help="additional packages to include")
+    arg_parser.add_argument('--num_workers', type=int, default=1,
+                            help="Number of examples to solve concurrently in inference mode.")
+    arg_parser.add_argument('--batch_backend', type=str, required=False,
+                            choices=["concurrent", "openai_batch"],
+                            help="Advance --num_workers examples in lock-step rounds and send the "
+                                 "LLM requests of each round as one batch via this backend")
+    arg_parser.add_argument('--num_shards', type=int, default=1,
+                            help="Split the input examples into these many shards (e.g. one per "
+                                 "machine) and only run on the shard specified by --shard_index. "
+                                 "Use recoma.merge_predictions to combine the shard outputs.")
+    arg_parser.add_argument('--shard_index', type=int, default=0,
+                            help="Index of the shard to run on (0-indexed)")
+    arg_parser.add_argument('--shard_by', type=str, choices=["hash", "position"], default="hash",
+                            help="Assign examples to shards by a stable hash of their id or by "
+                                 "their position in the input")
+    arg_parser.add_argument('--resume', action='store_true', default=False,
+                            help="Resume a previous run in the same output directory by skipping "
+                                 "the examples already completed in all_data.jsonl.")
+    arg_parser.add_argument('--max_run_time', type=float, required=False,
+                            help="Time budget (in seconds) for the whole run. Examples in flight "
+                                 "at the deadline return their best state so far (recorded as a "
+                                 "timeout in the metadata) and no new examples are started. "
+                                 "--resume re-runs these examples.")
+    arg_parser.add_argument('--use_async', action='store_true', default=False,
+                            help="Solve examples concurrently on a single event loop using the "
+                                 "async API (--num_workers sets the number of concurrent "
+                                 "examples).")
     return arg_parser.parse_args()
 
 
@@ -108,64 +143,125 @@ def demo_mode(args, configurable_systems: ConfigurableSystems):
 
 def inference_mode(args, configurable_systems: ConfigurableSystems):
     print("Running inference on examples")
-    example_predictions = []
-
     reader = configurable_systems.reader
     search_algo = configurable_systems.search
     Path(args.output_dir).mkdir(parents=True, exist_ok=True)
     with open(args.output_dir + "/source_config.json", "w") as output_fp:
         output_fp.write(json.dumps(configurable_systems.source_json, indent=2))
-    for example in reader.get_examples(args.input):
-        example_predictions.append(search_algo.predict(example))
-    dump_predictions(args, example_predictions)
-
-
-def dump_predictions(args, example_predictions: List[ExamplePrediction]):
-    if args.dump_prompts:
-        Path(args.output_dir + "/prompts_dump").mkdir(parents=True, exist_ok=True)
-    # Dump trees and I/O Prompts
-    for ex in example_predictions:
-        if args.dump_prompts:
-            with open(args.output_dir + "/prompts_dump/" + ex.example.qid + "_prompts.txt",
-                      "w") as output_fp:
-                if ex.final_state:
-                    output_fp.write(ex.final_state.all_input_output_prompts())
-    # Dump Predictions
-    with open(args.output_dir + "/predictions.json", "w") as output_fp, \
-            open(args.output_dir + "/all_data.jsonl", "w") as all_data_fp:
-        prediction_dump = {}
-        total_score = 0
-        for x in example_predictions:
-            metadata_json = {}
-            try:
-                pred_json = json.loads(x.prediction)
-                if not isinstance(pred_json, list) and not isinstance(pred_json, dict):
-                    pred_json = x.prediction
-                elif isinstance(pred_json, dict):
-                    if "metadata" in pred_json:
-                        metadata_json = pred_json.pop("metadata")
-                    if "answer" in pred_json:
-                        pred_json = pred_json["answer"]
-            except Exception:
-                pred_json = x.prediction
-            all_data_dict = x.example.__dict__
-            all_data_dict["predicted"] = pred_json
-            if x.final_state and x.final_state.data:
-                metadata_json = x.final_state.data | metadata_json
-            if isinstance(x.example.label, list) and len(x.example.label) == 1:
-                gold_answer = x.example.label[0]
-            else:
-                gold_answer = x.example.label
-            score = 1 if (x.prediction == gold_answer) else 0
-            all_data_dict["correct"] = str(score)
-            if metadata_json:
-                all_data_dict["metadata"] = metadata_json
-            total_score += score
-            all_data_fp.write(json.dumps(all_data_dict) + "\n")
-            prediction_dump[x.example.unique_id] = pred_json
-        print("EM Score: {} ({}/{})".format(100 * total_score / len(example_predictions),
-                                            total_score, len(example_predictions)))
-        json.dump(prediction_dump, output_fp)
+    # Predictions are written as soon as each example is solved
+    writer = PredictionWriter(args.output_dir, dump_prompts=args.dump_prompts,
+                              resume=args.resume)
+    examples = (example for example in reader.get_examples(args.input,
+                                                          shard_index=args.shard_index,
+                                                          num_shards=args.num_shards,
+                                                          shard_by=args.shard_by)
+                if example.unique_id not in writer.completed_ids)
+    if args.max_run_time is not None:
+        search_algo.run_deadline = time.monotonic() + args.max_run_time
+        examples = itertools.takewhile(
+            lambda example: time.monotonic() < search_algo.run_deadline, examples)
+    try:
+        if args.batch_backend:
+            driver = BatchSearchDriver(search_algo,
+                                       BatchBackend.from_dict({"type": args.batch_backend}),
+                                       max_active_examples=args.num_workers)
+            asyncio.run(awrite_batched_predictions(driver, examples, writer))
+        elif args.use_async:
+            asyncio.run(awrite_predictions(search_algo, examples, writer,
+                                           num_workers=args.num_workers))
+        else:
+            for prediction in predict_examples(search_algo, examples,
+                                               num_workers=args.num_workers):
+                writer.write(prediction)
+    finally:
+        search_algo.close()
+        writer.close()
+    writer.summarize()
+
+
+def predict_example_safely(search_algo: SearchAlgo, example: Example) -> ExamplePrediction:
+    """
+    Run the search on a single example, converting any failure into an empty prediction so that
+    one bad example does not bring down the whole run
+    """
+    try:
+        return search_algo.predict(example)
+    except Exception as e:
+        logger.exception("Failed to produce prediction for: {}".format(example.unique_id))
+        return ExamplePrediction(example=example, prediction="", final_state=None,
+                                 error=repr(e))
+
+
+async def apredict_example_safely(search_algo: SearchAlgo,
+                                  example: Example) -> ExamplePrediction:
+    """
+    Async version of predict_example_safely
+    """
+    try:
+        return await search_algo.apredict(example)
+    except Exception as e:
+        logger.exception("Failed to produce prediction for: {}".format(example.unique_id))
+        return ExamplePrediction(example=example, prediction="", final_state=None,
+                                 error=repr(e))
+
+
+def predict_examples(search_algo: SearchAlgo, examples: Iterable[Example],
+                     num_workers: int = 1) -> Iterable[ExamplePrediction]:
+    """
+    Produce predictions for the input examples using a bounded pool of worker threads. Predictions
+    are yielded in the same order as the input examples irrespective of their completion order.
+    :param search_algo: search algorithm used to solve each example
+    :param examples: stream of input examples
+    :param num_workers: max number of examples being solved at the same time
+    :return: streaming ExamplePrediction objects (in input order)
+    """
+    if num_workers <= 1:
+        for example in examples:
+            yield predict_example_safely(search_algo, example)
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Only keep a bounded window of examples in flight to avoid reading the entire dataset
+        # (and holding all the final states) in memory
+        pending = deque()
+        for example in examples:
+            pending.append(executor.submit(predict_example_safely, search_algo, example))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+async def apredict_examples(search_algo: SearchAlgo, examples: Iterable[Example],
+                            num_workers: int = 1) -> AsyncIterator[ExamplePrediction]:
+    """
+    Async version of predict_examples where the examples are solved as concurrent tasks on the
+    running event loop instead of worker threads
+    """
+    semaphore = asyncio.Semaphore(max(num_workers, 1))
+
+    async def bounded_predict(example):
+        async with semaphore:
+            return await apredict_example_safely(search_algo, example)
+
+    pending = deque()
+    for example in examples:
+        pending.append(asyncio.create_task(bounded_predict(example)))
+        if len(pending) >= 2 * num_workers:
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+
+async def awrite_predictions(search_algo: SearchAlgo, examples: Iterable[Example],
+                             writer: PredictionWriter, num_workers: int = 1):
+    async for prediction in apredict_examples(search_algo, examples, num_workers=num_workers):
+        writer.write(prediction)
+
+
+async def awrite_batched_predictions(driver: BatchSearchDriver, examples: Iterable[Example],
+                                     writer: PredictionWriter):
+    async for prediction in driver.apredict_examples(examples):
+        writer.write(prediction)
 
 
 def gradio_demo_fn(args, configurable_systems: ConfigurableSystems,
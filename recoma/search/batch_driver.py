@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import logging
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from recoma.datasets.reader import Example
+from recoma.models.core.batch_backend import BatchBackend, BatchCollector
+from recoma.search.deadline import DeadlineExceeded, set_deadline
+from recoma.search.search import ExamplePrediction, SearchAlgo
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSearchDriver:
+    """
+    Advances the search for all the active examples in lock-step. In each round, the next state of
+    every active example (as yielded by SearchAlgo.search_steps) is expanded concurrently, the API
+    requests made by these expansions are collected and sent as one batch via the BatchBackend, and
+    the expanded states are passed back to each example's search. Examples that are solved are
+    replaced by new examples in the next round. As in run_inference.predict_examples, predictions
+    are yielded in the input order and only a bounded window of examples (2 * max_active_examples)
+    can be started but not yet yielded.
+    """
+
+    def __init__(self, search_algo: SearchAlgo, backend: BatchBackend,
+                 max_active_examples: int = 100, max_batch_size: Optional[int] = None):
+        """
+        :param search_algo: search algorithm (must implement search_steps)
+        :param backend: backend used to send each batch of requests
+        :param max_active_examples: max number of examples advanced in each round
+        :param max_batch_size: send a batch early once it has these many requests
+        """
+        if type(search_algo).search_steps is SearchAlgo.search_steps:
+            raise ValueError("Batched search needs a search algorithm that implements "
+                             "search_steps: {}".format(type(search_algo).__name__))
+        self.search_algo = search_algo
+        self.backend = backend
+        self.max_active_examples = max_active_examples
+        self.max_batch_size = max_batch_size
+
+    @staticmethod
+    def error_prediction(example: Example, error: BaseException) -> ExamplePrediction:
+        logger.error("Failed to produce prediction for: {}".format(example.unique_id),
+                     exc_info=error)
+        return ExamplePrediction(example=example, prediction="", final_state=None,
+                                 error=repr(error))
+
+    async def apredict_examples(self,
+                                examples: Iterable[Example]) -> AsyncIterator[ExamplePrediction]:
+        """
+        Solve the examples in lock-step rounds
+        :return: streaming ExamplePrediction objects (in input order)
+        """
+        collector = BatchCollector(self.backend, max_batch_size=self.max_batch_size)
+        example_iter = iter(examples)
+        # (input index, example, search steps, state(s) to expand next, (deadline, reason) of the
+        # example)
+        active: List[tuple] = []
+        # input index -> prediction of the examples solved before the earlier examples
+        finished: Dict[int, ExamplePrediction] = {}
+        num_started = 0
+        next_index = 0
+        num_rounds = 0
+        while True:
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+            # fill up the active examples
+            while len(active) < self.max_active_examples and \
+                    num_started - next_index < 2 * self.max_active_examples:
+                example = next(example_iter, None)
+                if example is None:
+                    break
+                index = num_started
+                num_started += 1
+                steps = self.search_algo.search_steps(example)
+                deadline = self.search_algo.example_deadline()
+                try:
+                    active.append((index, example, steps, next(steps), deadline))
+                except StopIteration as stop:
+                    finished[index] = stop.value
+                except Exception as e:
+                    finished[index] = self.error_prediction(example, e)
+            if not active:
+                if next_index in finished:
+                    continue
+                break
+
+            num_rounds += 1
+            logger.debug("Round {}: expanding {} examples".format(num_rounds, len(active)))
+            token = collector.activate()
+            try:
+                # search algorithms can yield a list of states to be expanded concurrently
+                step_states = [states if isinstance(states, list) else [states]
+                               for _, _, _, states, _ in active]
+                collector.add_active(sum(len(states) for states in step_states))
+                tasks = []
+                for (_, _, _, _, deadline), states in zip(active, step_states):
+                    # run the expansions of each example with its own deadline
+                    context = contextvars.copy_context()
+                    context.run(set_deadline, *deadline)
+                    for state in states:
+                        # the task copies the context it is created in
+                        tasks.append(context.run(asyncio.create_task, collector.run(
+                            self.search_algo.aexecute_with_deadline(state))))
+            finally:
+                collector.deactivate(token)
+            all_results = await asyncio.gather(*tasks, return_exceptions=True)
+            results = []
+            offset = 0
+            for (_, _, _, states, _), expanded in zip(active, step_states):
+                step_results = all_results[offset:offset + len(expanded)]
+                offset += len(expanded)
+                error = next((result for result in step_results
+                              if isinstance(result, BaseException)), None)
+                if error is not None:
+                    results.append(error)
+                else:
+                    results.append(step_results if isinstance(states, list) else step_results[0])
+
+            next_active = []
+            for (index, example, steps, _, deadline), new_states in zip(active, results):
+                try:
+                    if isinstance(new_states, DeadlineExceeded):
+                        # the search returns the best state so far
+                        next_states = steps.throw(new_states)
+                    elif isinstance(new_states, BaseException):
+                        steps.close()
+                        finished[index] = self.error_prediction(example, new_states)
+                        continue
+                    else:
+                        next_states = steps.send(new_states)
+                    next_active.append((index, example, steps, next_states, deadline))
+                except StopIteration as stop:
+                    finished[index] = stop.value
+                except Exception as e:
+                    finished[index] = self.error_prediction(example, e)
+            active = next_active
@@ -0,0 +1,70 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+# Reasons for a deadline
+EXAMPLE_DEADLINE = "max_wall_time"
+RUN_DEADLINE = "run_deadline"
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised (cooperatively) when the time budget of the current example or run is used up
+    """
+
+    def __init__(self, reason: str):
+        super().__init__("Deadline exceeded: {}".format(reason))
+        self.reason = reason
+
+
+# (deadline as per time.monotonic(), reason) for the example being solved in this context
+_deadline: contextvars.ContextVar[Optional[Tuple[float, str]]] = \
+    contextvars.ContextVar("search_deadline", default=None)
+
+
+def get_deadline() -> Optional[Tuple[float, str]]:
+    """
+    :return: the deadline (as per time.monotonic()) and its reason for the current context, if any
+    """
+    return _deadline.get()
+
+
+def set_deadline(deadline: Optional[float], reason: Optional[str]):
+    """
+    Set the deadline for the current context (e.g. a new task for an example)
+    """
+    return _deadline.set(None if deadline is None else (deadline, reason))
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float], reason: Optional[str]):
+    """
+    Set the deadline for the code run in this scope (and the tasks/threads started from it that
+    copy the context)
+    """
+    token = set_deadline(deadline, reason)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """
+    :return: seconds left till the deadline of the current context or None if there is no deadline
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline[0] - time.monotonic()
+
+
+def check_deadline(wait_time: float = 0):
+    """
+    Raise DeadlineExceeded if the deadline of the current context has passed (or will pass within
+    wait_time seconds)
+    """
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() + wait_time >= deadline[0]:
+        raise DeadlineExceeded(deadline[1])
@@ -1,7 +1,5 @@
-from collections import Counter
 import logging
 from abc import abstractmethod
-import re
 
 from recoma.search.state import SearchState
 from recoma.utils.class_utils import RegistrableFromDict
@@ -50,15 +48,7 @@ class MaximumLLMCalls(EarlyStoppingCondition):
         self.max_llm_calls = max_llm_calls
 
     def should_stop(self, current_state: SearchState, num_iters: int, heap: list[SearchState]):
-        counter = Counter()
-        for key, value in current_state.data.items():
-            m = re.match("openai.(.*).calls", key)
-            if m:
-                counter[m.group(1)] += value
-            m = re.match("litellm.(.*).calls", key)
-            if m:
-                counter[m.group(1)] += value
-        num_calls = sum(counter.values())
+        num_calls = current_state.usage.total.calls
         if num_calls >= self.max_llm_calls:
             logger.warning("Hit max calls: {} >= {}".format(num_calls, self.max_llm_calls))
             return True
@@ -71,16 +61,28 @@ class MaximumLLMCost(EarlyStoppingCondition):
         self.max_llm_cost = max_llm_cost
 
     def should_stop(self, current_state: SearchState, num_iters: int, heap: list[SearchState]):
-        counter = Counter()
-        for key, value in current_state.data.items():
-            m = re.match("openai.(.*).cost", key)
-            if m:
-                counter[m.group(1)] += value
-            m = re.match("litellm.(.*).cost", key)
-            if m:
-                counter[m.group(1)] += value
-        total_cost = sum(counter.values())
+        total_cost = current_state.usage.total.cost
         if total_cost >= self.max_llm_cost:
             logger.warning("Hit max cost: {} >= {}".format(total_cost, self.max_llm_cost))
             return True
         return False
+
+
+@EarlyStoppingCondition.register("max_wall_time")
+class MaxWallTime(EarlyStoppingCondition):
+    """
+    Stop exploring states once the example has been running for max_wall_time seconds. The search
+    also uses this as the time budget of the example, i.e. the in-flight model calls are cancelled
+    and the best state so far is returned when the time runs out.
+    """
+    def __init__(self, max_wall_time=600, **kwargs):
+        super().__init__(**kwargs)
+        self.max_wall_time = max_wall_time
+
+    def should_stop(self, current_state: SearchState, num_iters: int, heap: list[SearchState]):
+        elapsed_time = current_state.elapsed_time()
+        if elapsed_time >= self.max_wall_time:
+            logger.warning("Hit max wall time: {:.1f}s >= {}s".format(elapsed_time,
+                                                                     self.max_wall_time))
+            return True
+        return False
@@ -0,0 +1,98 @@
+import threading
+import weakref
+from typing import Optional, Union
+
+
+class PromptChunk:
+    """
+    A piece of prompt text stored once in the PromptStore
+    """
+    __slots__ = ("text", "__weakref__")
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class PromptRef:
+    """
+    Compact reference to a prompt in the PromptStore: a (shared) prefix chunk, e.g. the few-shot
+    examples and paragraphs rendered once per example, and the (shared) chunk with the rest of the
+    prompt. Resolved to the full prompt string on demand. Immutable, so copies share the chunks.
+    """
+    __slots__ = ("prefix", "suffix")
+
+    def __init__(self, prefix: Optional[PromptChunk], suffix: PromptChunk):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def resolve(self) -> str:
+        if self.prefix is None:
+            return self.suffix.text
+        return self.prefix.text + self.suffix.text
+
+    def approx_size(self) -> int:
+        """
+        Approximate memory (in bytes) of the prompt text not shared with other prompts
+        """
+        return len(self.suffix.text)
+
+    def __str__(self):
+        return self.resolve()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PromptStore:
+    """
+    Content-addressed store for the prompts in the search states of a run. Identical prompts (and
+    identical prompt prefixes) are stored only once and the nodes keep PromptRefs to them. Chunks
+    are only kept alive by the PromptRefs pointing to them, so the prompts of finished examples are
+    freed with their states.
+    """
+
+    def __init__(self):
+        # text -> chunk with that text (the key is the chunk's own string)
+        self._chunks: "weakref.WeakValueDictionary[str, PromptChunk]" = \
+            weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def intern(self, text: str) -> PromptChunk:
+        """
+        :return: the stored chunk with this text, adding it if needed
+        """
+        with self._lock:
+            chunk = self._chunks.get(text)
+            if chunk is None:
+                chunk = PromptChunk(text)
+                self._chunks[text] = chunk
+            return chunk
+
+    def put(self, prompt: str, prefix: Optional[str] = None) -> PromptRef:
+        """
+        Store the prompt
+        :param prompt: prompt text
+        :param prefix: prefix of the prompt that is shared with other prompts (if known), e.g. the
+        rendered prompt before the input string
+        :return: reference to the stored prompt
+        """
+        if prefix and prompt.startswith(prefix):
+            return PromptRef(self.intern(prefix), self.intern(prompt[len(prefix):]))
+        return PromptRef(None, self.intern(prompt))
+
+    def __len__(self):
+        return len(self._chunks)
+
+
+# Prompt store shared by all the searches in this process (i.e. the run)
+prompt_store = PromptStore()
+
+
+def resolve_prompt(prompt: Union[str, PromptRef]) -> str:
+    """
+    :return: the prompt string for a PromptRef (or a plain prompt string)
+    """
+    return prompt if isinstance(prompt, str) else prompt.resolve()
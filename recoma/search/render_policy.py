@@ -0,0 +1,58 @@
+import threading
+import time
+from abc import abstractmethod
+
+from recoma.utils.class_utils import RegistrableFromDict
+
+
+class RenderPolicy(RegistrableFromDict):
+    """
+    Decides when the current search state of an example should be rendered to the output files.
+    The final state of every example is always rendered.
+    """
+
+    @abstractmethod
+    def should_render(self, example_id: str, num_iters: int, is_final: bool) -> bool:
+        raise NotImplementedError
+
+
+@RenderPolicy.register("final_only")
+class FinalOnlyRenderPolicy(RenderPolicy):
+
+    def should_render(self, example_id: str, num_iters: int, is_final: bool) -> bool:
+        return is_final
+
+
+@RenderPolicy.register("every_n_iters")
+class EveryNItersRenderPolicy(RenderPolicy):
+    def __init__(self, n: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.n = n
+
+    def should_render(self, example_id: str, num_iters: int, is_final: bool) -> bool:
+        return is_final or num_iters % self.n == 0
+
+
+@RenderPolicy.register("time_throttled")
+class TimeThrottledRenderPolicy(RenderPolicy):
+    """
+    Render the state of an example at most once every min_interval seconds
+    """
+    def __init__(self, min_interval: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_interval = min_interval
+        # examples may be solved concurrently
+        self._lock = threading.Lock()
+        self._last_render_time: dict[str, float] = {}
+
+    def should_render(self, example_id: str, num_iters: int, is_final: bool) -> bool:
+        with self._lock:
+            if is_final:
+                self._last_render_time.pop(example_id, None)
+                return True
+            current_time = time.time()
+            last_time = self._last_render_time.get(example_id)
+            if last_time is None or current_time - last_time >= self.min_interval:
+                self._last_render_time[example_id] = current_time
+                return True
+            return False
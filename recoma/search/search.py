@@ -1,12 +1,22 @@
+import asyncio
+import contextvars
 import heapq
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from dataclasses import dataclass
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 from recoma.datasets.reader import Example
 from recoma.search.answerfromstate import TailOutputAnswerer, AnswerFromState
-from recoma.search.early_stopping import EarlyStoppingCondition
-from recoma.search.state import SearchState
+from recoma.search.deadline import (EXAMPLE_DEADLINE, RUN_DEADLINE, DeadlineExceeded,
+                                    check_deadline, deadline_scope, remaining_time)
+from recoma.search.early_stopping import EarlyStoppingCondition, MaxWallTime
+from recoma.search.render_policy import RenderPolicy
+from recoma.search.state import MemoizedSubtree, SearchState, StateSizeTracker
 from recoma.utils.class_utils import RegistrableFromDict
+from recoma.utils.render_writer import BackgroundRenderWriter
 
 logger = logging.getLogger(__name__)
 
@@ -15,14 +25,23 @@ logger = logging.getLogger(__name__)
 class ExamplePrediction:
     example: Example
     prediction: str
-    final_state: SearchState
+    final_state: Optional[SearchState]
+    error: Optional[str] = None
 
 class SearchAlgo(RegistrableFromDict):
     def __init__(self, model_list, start_model,
                  renderers=None, answerer=None, stopping_conditions=None,
-                 output_dir=None, **kwargs):
+                 output_dir=None, render_policy=None, memoize_subtrees=False, **kwargs):
+        """
+        :param memoize_subtrees: re-use the completed subtree of an earlier node in the same example
+        with the same target model and input string (for models that allow memoization) instead of
+        calling the model again
+        """
         super().__init__(**kwargs)
         self.model_list = model_list
+        self.memoize_subtrees = memoize_subtrees
+        self.uses_answer_cache = any(getattr(model, "answer_cache", None) is not None
+                                     for model in model_list.values())
         self.answerer = TailOutputAnswerer() if answerer is None \
             else AnswerFromState.from_dict(answerer)
         self.start_model = start_model
@@ -38,6 +57,155 @@ class SearchAlgo(RegistrableFromDict):
             ]
         self.output_dir = output_dir
         self.renderers = renderers
+        self.render_policy = RenderPolicy.from_dict({"type": "every_n_iters"}) \
+            if render_policy is None else RenderPolicy.from_dict(render_policy)
+        self.render_writer = BackgroundRenderWriter(renderers) if renderers else None
+        # Time budget per example from the max_wall_time stopping condition (if any). When it runs
+        # out, the in-flight model calls are cancelled and the best state so far is returned.
+        self.max_wall_time = min((condition.max_wall_time for condition in self.stopping_conditions
+                                  if isinstance(condition, MaxWallTime)), default=None)
+        # Deadline (as per time.monotonic()) for the whole run, e.g. set via --max_run_time
+        self.run_deadline: Optional[float] = None
+
+    def example_deadline(self) -> Tuple[Optional[float], Optional[str]]:
+        """
+        :return: the deadline (as per time.monotonic()) for an example starting now and the reason
+        (EXAMPLE_DEADLINE or RUN_DEADLINE), or (None, None) if there is no time limit
+        """
+        deadline, reason = None, None
+        if self.max_wall_time is not None:
+            deadline, reason = time.monotonic() + self.max_wall_time, EXAMPLE_DEADLINE
+        if self.run_deadline is not None and (deadline is None or self.run_deadline < deadline):
+            deadline, reason = self.run_deadline, RUN_DEADLINE
+        return deadline, reason
+
+    @staticmethod
+    def best_state_so_far(states: List[SearchState]) -> SearchState:
+        """
+        Best state to answer from when the search is stopped early: the best-scoring complete
+        state, if any, else the best-scoring state
+        """
+        complete_states = [state for state in states if not state.has_open_node()]
+        return min(complete_states or states)
+
+    @staticmethod
+    def record_timeout(example: Example, state: SearchState, error: DeadlineExceeded):
+        logger.warning("Timed out ({}): {}".format(error.reason, example.unique_id))
+        state.data["timeout"] = error.reason
+        state.update_counter("search.timeouts", 1)
+
+    def render_state(self, example: Example, state: SearchState, num_iters: int,
+                     is_final: bool = False):
+        """
+        Schedule the state to be written to the output files by the renderers (if allowed by the
+        render policy). The files are written on a background thread.
+        """
+        if not self.output_dir or not self.render_writer:
+            return
+        if self.render_policy.should_render(example.unique_id, num_iters, is_final):
+            # The clone is cheap (copy-on-write) and protects the snapshot from later modifications
+            self.render_writer.submit(self.output_dir + "/" + clean_name(example.unique_id),
+                                      state.clone())
+
+    def close(self):
+        """
+        Wait for all the pending output files to be written
+        """
+        if self.render_writer:
+            self.render_writer.close()
+
+    def is_memoizable(self, target_model: str) -> bool:
+        return target_model in self.model_list and self.model_list[target_model].should_memoize()
+
+    def get_memoized_states(self, current_state: SearchState) -> Optional[List[SearchState]]:
+        """
+        If a node with the same target model and input as the (unprocessed) open node has been
+        completed earlier in this example, close the open node with the same output and copy the
+        completed subtree under it
+        :return: the new states or None if the node can not be memoized
+        """
+        if not self.memoize_subtrees:
+            return None
+        open_node = current_state.get_open_node()
+        memo_entry = current_state.subtree_memo.get((open_node.target, open_node.input_str))
+        if memo_entry is None:
+            return None
+        memo_node = memo_entry.nodes[0][0]
+        new_state = current_state.clone()
+        current_node = new_state.get_open_node()
+        current_node.close(output=memo_node.output)
+        # the prompts are kept (but marked as memoized) so that the trace is complete
+        current_node.data.update(deepcopy(memo_node.data))
+        current_node.data["memoized"] = True
+        new_state.add_subtree_snapshot(memo_entry.nodes, current_node.identifier,
+                                       data_update={"memoized": True})
+        # rank the state as if the subtree had been expanded again
+        new_state.update_score(memo_entry.score)
+        new_state.update_counter("search.memo_hits", 1)
+        return [new_state]
+
+    @staticmethod
+    def build_cached_answer_states(current_state: SearchState, answer: str) -> List[SearchState]:
+        """
+        Close the open node with the answer from the (cross-example) answer cache
+        """
+        new_state = current_state.clone()
+        current_node = new_state.get_open_node()
+        current_node.close(output=answer)
+        current_node.data["answer_cached"] = True
+        return [new_state]
+
+    def get_completed_subtrees(self, nid: int,
+                               output_states: List[SearchState]) -> List[Tuple[SearchState, int]]:
+        """
+        Find the subtrees completed by the expansion of the node nid, i.e. the node and its
+        ancestors that are now closed along with all their descendants. Only subtrees where every
+        node is assigned to a memoizable model are returned.
+        :return: list of (state, root node id of the subtree)
+        """
+        completed_subtrees = []
+        if not self.memoize_subtrees and not self.uses_answer_cache:
+            return completed_subtrees
+        for state in output_states:
+            current_nid = nid
+            while current_nid is not None and current_nid in state and \
+                    state.is_subtree_closed(current_nid):
+                if all(self.is_memoizable(state[sub_nid].target)
+                       for sub_nid in state.preorder_traversal(current_nid)):
+                    completed_subtrees.append((state, current_nid))
+                parent_node = state.parent(current_nid)
+                current_nid = None if parent_node is None else parent_node.identifier
+        return completed_subtrees
+
+    def memoize_subtrees_in_states(self, completed_subtrees: List[Tuple[SearchState, int]]):
+        """
+        Record the completed subtrees in the per-example memo
+        """
+        if not self.memoize_subtrees:
+            return
+        for state, nid in completed_subtrees:
+            node = state[nid]
+            memo_key = (node.target, node.input_str)
+            subtree_score = state.subtree_score(nid)
+            # only the nodes are kept, not the (much larger) state
+            if memo_key not in state.subtree_memo and subtree_score is not None:
+                state.subtree_memo[memo_key] = MemoizedSubtree(nodes=state.subtree_snapshot(nid),
+                                                               score=subtree_score)
+
+    def cache_answers(self, completed_subtrees: List[Tuple[SearchState, int]]):
+        """
+        Add the outputs of the completed subtrees to the answer cache of their models (if any)
+        """
+        for state, nid in completed_subtrees:
+            node = state[nid]
+            self.model_list[node.target].set_cached_answer(node.target, node.input_str, state,
+                                                           node.output)
+
+    async def acache_answers(self, completed_subtrees: List[Tuple[SearchState, int]]):
+        for state, nid in completed_subtrees:
+            node = state[nid]
+            await self.model_list[node.target].aset_cached_answer(node.target, node.input_str,
+                                                                  state, node.output)
 
     def execute(self, current_state: SearchState):
         open_node = current_state.get_open_node()
@@ -46,17 +214,160 @@ class SearchAlgo(RegistrableFromDict):
             if target_model not in self.model_list:
                 logger.error("Can not handle next state: " + str(target_model))
                 return []
+            current_state.record_expansion_start(open_node.identifier)
+            # re-use the outputs for unprocessed nodes with repeated inputs
+            if self.is_memoizable(target_model) and \
+                    not current_state.get_children_ids(open_node.identifier):
+                memoized_states = self.get_memoized_states(current_state)
+                if memoized_states is not None:
+                    return memoized_states
+                answer = self.model_list[target_model].get_cached_answer(
+                    target_model, open_node.input_str, current_state)
+                if answer is not None:
+                    return self.build_cached_answer_states(current_state, answer)
             try:
                 output_states = self.model_list[target_model](current_state)
+                completed_subtrees = self.get_completed_subtrees(open_node.identifier,
+                                                                 output_states)
+                self.memoize_subtrees_in_states(completed_subtrees)
+                self.cache_answers(completed_subtrees)
                 return output_states
             except RecursionError:
                 return []
         else:
             raise ValueError("No open nodes in current state:" + str(current_state))
 
-    def predict(self, example: Example) -> ExamplePrediction:
+    async def aexecute(self, current_state: SearchState):
+        open_node = current_state.get_open_node()
+        if open_node is not None:
+            target_model = open_node.target_model()
+            if target_model not in self.model_list:
+                logger.error("Can not handle next state: " + str(target_model))
+                return []
+            current_state.record_expansion_start(open_node.identifier)
+            # re-use the outputs for unprocessed nodes with repeated inputs
+            if self.is_memoizable(target_model) and \
+                    not current_state.get_children_ids(open_node.identifier):
+                memoized_states = self.get_memoized_states(current_state)
+                if memoized_states is not None:
+                    return memoized_states
+                answer = await self.model_list[target_model].aget_cached_answer(
+                    target_model, open_node.input_str, current_state)
+                if answer is not None:
+                    return self.build_cached_answer_states(current_state, answer)
+            try:
+                output_states = await self.model_list[target_model].acall(current_state)
+                completed_subtrees = self.get_completed_subtrees(open_node.identifier,
+                                                                 output_states)
+                self.memoize_subtrees_in_states(completed_subtrees)
+                await self.acache_answers(completed_subtrees)
+                return output_states
+            except RecursionError:
+                return []
+        else:
+            raise ValueError("No open nodes in current state:" + str(current_state))
+
+    def execute_all(self, states: List[SearchState]) -> List[List[SearchState]]:
+        """
+        Expand the states concurrently (on threads)
+        :return: the list of expanded states for each input state
+        """
+        if len(states) <= 1:
+            return [self.execute(state) for state in states]
+        # run each expansion in a copy of the current context (e.g. with the example's deadline)
+        contexts = [contextvars.copy_context() for _ in states]
+        with ThreadPoolExecutor(max_workers=len(states)) as executor:
+            return list(executor.map(lambda context, state: context.run(self.execute, state),
+                                     contexts, states))
+
+    async def aexecute_all(self, states: List[SearchState]) -> List[List[SearchState]]:
+        """
+        Async version of execute_all
+        """
+        return list(await asyncio.gather(*[self.aexecute(state) for state in states]))
+
+    def search_steps(self, example: Example) -> Generator[
+            Union[SearchState, List[SearchState]],
+            Union[List[SearchState], List[List[SearchState]]],
+            ExamplePrediction]:
+        """
+        Search procedure written as a generator that yields the next state to be expanded and
+        receives the list of expanded states back. The same search can then be driven by the
+        synchronous predict and the asynchronous apredict functions. To expand multiple states
+        concurrently, yield a list of states and receive the list of expanded states for each one.
+        If the time budget runs out, DeadlineExceeded is thrown into the generator at the yield and
+        the search should return a prediction from the best state so far.
+        :param example: input example
+        :return: the final ExamplePrediction (as the generator's return value)
+        """
         raise NotImplementedError
 
+    def predict(self, example: Example) -> ExamplePrediction:
+        steps = self.search_steps(example)
+        # Threads can not be interrupted, so the model calls check the deadline cooperatively (e.g.
+        # before every retry)
+        with deadline_scope(*self.example_deadline()):
+            try:
+                current_state = next(steps)
+                while True:
+                    try:
+                        check_deadline()
+                        if isinstance(current_state, list):
+                            new_states = self.execute_all(current_state)
+                        else:
+                            new_states = self.execute(current_state)
+                    except DeadlineExceeded as e:
+                        current_state = steps.throw(e)
+                        continue
+                    current_state = steps.send(new_states)
+            except StopIteration as stop:
+                return stop.value
+
+    async def apredict(self, example: Example) -> ExamplePrediction:
+        if type(self).search_steps is SearchAlgo.search_steps:
+            # Search algorithms that only implement predict
+            return await asyncio.to_thread(self.predict, example)
+        steps = self.search_steps(example)
+        with deadline_scope(*self.example_deadline()):
+            try:
+                current_state = next(steps)
+                while True:
+                    try:
+                        new_states = await self.aexecute_with_deadline(current_state)
+                    except DeadlineExceeded as e:
+                        current_state = steps.throw(e)
+                        continue
+                    current_state = steps.send(new_states)
+            except StopIteration as stop:
+                return stop.value
+
+    async def aexecute_with_deadline(self, states: Union[SearchState, List[SearchState]]):
+        """
+        Expand the state(s) yielded by search_steps, cancelling the expansion (and its in-flight
+        model calls) when the deadline of the current context is reached
+        :raises DeadlineExceeded: if the deadline was reached
+        """
+        check_deadline()
+        timeout = remaining_time()
+        if timeout is not None:
+            # Expansions in worker threads (asyncio.to_thread) can not be cancelled and keep
+            # modifying their state after a timeout, so they expand (copy-on-write) clones and the
+            # states that the search answers from are left untouched
+            states = [state.clone() for state in states] if isinstance(states, list) \
+                else states.clone()
+        if isinstance(states, list):
+            expansion = self.aexecute_all(states)
+        else:
+            expansion = self.aexecute(states)
+        if timeout is None:
+            return await expansion
+        try:
+            return await asyncio.wait_for(expansion, timeout)
+        except asyncio.TimeoutError:
+            # a timeout raised by the expansion itself (e.g. a failed API call) is not a deadline
+            check_deadline()
+            raise
+
 
 def clean_name(qid):
     return qid.replace("/", "_").replace("\\", "_").replace(".", "_")
@@ -65,7 +376,58 @@ def clean_name(qid):
 @SearchAlgo.register("best_first")
 class BestFirstSearch(SearchAlgo):
 
-    def predict(self, example):
+    def __init__(self, use_transposition_table: bool = False, max_heap_size: Optional[int] = None,
+                 max_heap_bytes: Optional[int] = None, **kwargs):
+        """
+        :param use_transposition_table: drop new states that are equivalent (same canonical key) to
+        a state already pushed to the heap for this example with the same or a better score, so the
+        same subtree is not expanded (and the same LLM calls paid for) again. Only useful when the
+        models sample multiple outputs, since every pushed state is hashed (O(tree size)).
+        :param max_heap_size: max number of states in the heap. The worst-scoring states are evicted
+        when it is exceeded.
+        :param max_heap_bytes: max approximate memory (see StateSizeTracker) of the states in the
+        heap. The worst-scoring states are evicted when it is exceeded.
+        """
+        super().__init__(**kwargs)
+        self.use_transposition_table = use_transposition_table
+        if max_heap_size is not None and max_heap_size < 1:
+            raise ValueError("max_heap_size must be at least 1: {}".format(max_heap_size))
+        self.max_heap_size = max_heap_size
+        self.max_heap_bytes = max_heap_bytes
+
+    def final_prediction(self, example: Example, state: SearchState,
+                         stats: Dict[str, float]) -> ExamplePrediction:
+        for key, value in stats.items():
+            state.update_counter(key, value)
+        answer = self.answerer.generate_answer(state)
+        return ExamplePrediction(example=example, prediction=answer, final_state=state)
+
+    def evict_states(self, heap: List[SearchState], heap_size: Optional[StateSizeTracker],
+                     stats: Dict[str, float]) -> List[SearchState]:
+        """
+        Evict the worst-scoring states from the heap (in place) until it is within max_heap_size
+        and max_heap_bytes. The best state is never evicted.
+        :param heap_size: size of the states in the heap (if max_heap_bytes is set)
+        :return: the evicted states
+        """
+        def is_over_limit():
+            return (self.max_heap_size is not None and len(heap) > self.max_heap_size) or (
+                    self.max_heap_bytes is not None and heap_size.total > self.max_heap_bytes)
+
+        evicted_states = []
+        if len(heap) <= 1 or not is_over_limit():
+            return evicted_states
+        # a sorted list is also a valid heap
+        heap.sort(key=lambda state: state.score)
+        while len(heap) > 1 and is_over_limit():
+            evicted_state = heap.pop()
+            if heap_size is not None:
+                heap_size.remove(evicted_state)
+            stats["search.heap_evictions"] += 1
+            evicted_states.append(evicted_state)
+        return evicted_states
+
+    def search_steps(self, example):
         init_state = SearchState(example=example, data={})
         # add root node
         init_state.add_next_step(next_step_input=example.task,
@@ -73,9 +435,29 @@ class BestFirstSearch(SearchAlgo):
                                  next_step_model=self.start_model,
                                  current_step_node=None)
         heap = []
+        # canonical key -> best score of the states pushed to the heap
+        transposition_table = {}
+        # id of a state in the heap -> its canonical key (if use_transposition_table is set)
+        state_keys = {}
+        # approximate size of the states in the heap (if max_heap_bytes is set)
+        heap_size = StateSizeTracker() if self.max_heap_bytes is not None else None
+        stats = {"search.heap_high_water": 1}
+        if self.use_transposition_table:
+            stats["search.skipped_expansions"] = 0
+        if self.max_heap_size is not None or self.max_heap_bytes is not None:
+            stats["search.heap_evictions"] = 0
+        if self.max_heap_bytes is not None:
+            heap_size.add(init_state)
+            stats["search.heap_high_water_bytes"] = heap_size.total
+
+        def final_prediction(state: SearchState) -> ExamplePrediction:
+            return self.final_prediction(example, state, stats)
 
         # push it to heap
         heapq.heappush(heap, init_state)
+        if self.use_transposition_table:
+            state_keys[id(init_state)] = init_state.canonical_key()
+            transposition_table[state_keys[id(init_state)]] = init_state.score
 
         # start the search
         iters = 0
@@ -83,45 +465,170 @@ class BestFirstSearch(SearchAlgo):
         while iters < 1_000_000:
             # pop from heap
             current_state = heapq.heappop(heap)
-            logger.debug("\n" + current_state.to_str_tree())
-            if self.output_dir and self.renderers:
-                for renderer in self.renderers:
-                    filename = self.output_dir + "/" + clean_name(example.unique_id) + \
-                        renderer.special_suffix + "." +  renderer.output_format
-                    with open(filename, "w") as fp:
-                        fp.write(renderer.output(current_state))
+            if heap_size is not None:
+                heap_size.remove(current_state)
+            # expanded states stay in the transposition table
+            key = state_keys.pop(id(current_state), None)
+            if key is not None and heap and \
+                    transposition_table.get(key, current_state.score) < current_state.score:
+                # a better equivalent state has been pushed after this one
+                stats["search.skipped_expansions"] += 1
+                continue
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("\n" + current_state.to_str_tree())
+            self.render_state(example, current_state, iters,
+                              is_final=not current_state.has_open_node())
             if not current_state.has_open_node():
                 # found a solution
-                answer = self.answerer.generate_answer(current_state)
-                logger.info(example.task + "\t" + answer)
-                return ExamplePrediction(example=example,
-                                         prediction=answer,
-                                         final_state=current_state)
+                prediction = final_prediction(current_state)
+                logger.info(example.task + "\t" + prediction.prediction)
+                return prediction
             else:
                 logger.debug("Exploring ====> " + current_state.get_open_node().tag)
 
             iters += 1
             # generate new states
-            for new_state in self.execute(current_state):
+            try:
+                new_states = yield current_state
+            except DeadlineExceeded as e:
+                best_state = self.best_state_so_far([current_state] + heap)
+                self.record_timeout(example, best_state, e)
+                self.render_state(example, best_state, iters, is_final=True)
+                return final_prediction(best_state)
+            for new_state in new_states:
                 # check stopping conditions
                 should_stop = False
                 for stopping_condition in self.stopping_conditions:
                     if stopping_condition.should_stop(new_state, iters, heap):
                         should_stop = True
                         break
-                if not should_stop:
-                    heapq.heappush(heap, new_state)
+                if should_stop:
+                    continue
+                if self.use_transposition_table:
+                    key = new_state.canonical_key()
+                    if key in transposition_table and \
+                            transposition_table[key] <= new_state.score:
+                        # an equivalent state has already been pushed
+                        stats["search.skipped_expansions"] += 1
+                        continue
+                    transposition_table[key] = new_state.score
+                    state_keys[id(new_state)] = key
+                heapq.heappush(heap, new_state)
+                if heap_size is not None:
+                    heap_size.add(new_state)
+            for evicted_state in self.evict_states(heap, heap_size, stats):
+                key = state_keys.pop(id(evicted_state), None)
+                # the evicted state was the best equivalent state pushed so far, so an equivalent
+                # state that is generated again should not be dropped because of it
+                if key is not None and transposition_table.get(key) == evicted_state.score:
+                    del transposition_table[key]
+            # after the evictions, i.e. within max_heap_size/bytes
+            stats["search.heap_high_water"] = max(stats["search.heap_high_water"], len(heap))
+            if heap_size is not None:
+                stats["search.heap_high_water_bytes"] = max(stats["search.heap_high_water_bytes"],
+                                                            heap_size.total)
 
             # Rather than failing at the beginning of the loop, fail at the end here and return the
             # current state
             if len(heap) == 0:
-                answer = self.answerer.generate_answer(current_state)
+                self.render_state(example, current_state, iters, is_final=True)
                 logger.warning("!EMPTY HEAP!: {}".format(example.unique_id))
-                return ExamplePrediction(example=example, prediction=answer, final_state=current_state)
+                return final_prediction(current_state)
 
         logger.error("NONE OF THE STOPPING CONDITIONS MET AFTER 1M STEPS!!: {}".format(example.unique_id))
         best_state = heapq.heappop(heap)
-        answer = self.answerer.generate_answer(best_state)
-        return ExamplePrediction(example=example,
-                                 prediction=answer,
-                                 final_state=best_state)
+        self.render_state(example, best_state, iters, is_final=True)
+        return final_prediction(best_state)
+
+
+@SearchAlgo.register("beam")
+class BeamSearch(SearchAlgo):
+    """
+    Beam search that keeps at most beam_width states in the frontier. In each iteration, all the
+    open states in the beam are expanded concurrently, equivalent states (same canonical key) are
+    merged keeping the best score, and only the beam_width best-scoring (i.e. lowest score) states
+    are kept. The search ends when the best state in the beam is complete.
+    """
+
+    def __init__(self, beam_width: int = 5, **kwargs):
+        """
+        :param beam_width: max number of states kept (and expanded) in each iteration
+        """
+        super().__init__(**kwargs)
+        if beam_width < 1:
+            raise ValueError("beam_width must be at least 1: {}".format(beam_width))
+        self.beam_width = beam_width
+
+    def final_prediction(self, example: Example, state: SearchState, num_iters: int,
+                         num_pruned: int, num_duplicates: int) -> ExamplePrediction:
+        state.update_counter("beam.pruned", num_pruned)
+        state.update_counter("beam.duplicates", num_duplicates)
+        self.render_state(example, state, num_iters, is_final=True)
+        answer = self.answerer.generate_answer(state)
+        logger.info("{}\t{}".format(example.task, answer))
+        return ExamplePrediction(example=example, prediction=answer, final_state=state)
+
+    def search_steps(self, example):
+        init_state = SearchState(example=example, data={})
+        # add root node
+        init_state.add_next_step(next_step_input=example.task,
+                                 next_step_input_for_display=example.task,
+                                 next_step_model=self.start_model,
+                                 current_step_node=None)
+        beam = [init_state]
+        num_pruned = 0
+        num_duplicates = 0
+        iters = 0
+        # Extremely high limit to catch infinite loops
+        while iters < 1_000_000:
+            best_state = beam[0]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("\n" + best_state.to_str_tree())
+            if not best_state.has_open_node():
+                # found a solution
+                return self.final_prediction(example, best_state, iters, num_pruned,
+                                             num_duplicates)
+            self.render_state(example, best_state, iters)
+
+            iters += 1
+            open_states = [state for state in beam if state.has_open_node()]
+            logger.debug("Expanding {} states in the beam".format(len(open_states)))
+            try:
+                expanded_states = yield open_states
+            except DeadlineExceeded as e:
+                best_state = self.best_state_so_far(beam)
+                self.record_timeout(example, best_state, e)
+                return self.final_prediction(example, best_state, iters, num_pruned,
+                                             num_duplicates)
+            # completed states stay in the beam as they could still be the best states
+            candidates = [state for state in beam if not state.has_open_node()]
+            for new_states in expanded_states:
+                for new_state in new_states:
+                    should_stop = False
+                    for stopping_condition in self.stopping_conditions:
+                        if stopping_condition.should_stop(new_state, iters, candidates):
+                            should_stop = True
+                            break
+                    if not should_stop:
+                        candidates.append(new_state)
+
+            if not candidates:
+                logger.warning("!EMPTY BEAM!: {}".format(example.unique_id))
+                return self.final_prediction(example, best_state, iters, num_pruned,
+                                             num_duplicates)
+
+            # merge equivalent states, keeping the best-scoring one
+            unique_states = {}
+            for state in candidates:
+                key = state.canonical_key()
+                if key not in unique_states or state < unique_states[key]:
+                    unique_states[key] = state
+            num_duplicates += len(candidates) - len(unique_states)
+            # stable sort, so ties are broken by the order of the expansions
+            beam = sorted(unique_states.values(), key=lambda state: state.score)
+            num_pruned += max(0, len(beam) - self.beam_width)
+            beam = beam[:self.beam_width]
+
+        logger.error("NONE OF THE STOPPING CONDITIONS MET AFTER 1M STEPS!!: {}".format(
+            example.unique_id))
+        return self.final_prediction(example, beam[0], iters, num_pruned, num_duplicates)
@@ -1,16 +1,26 @@
-from copy import deepcopy
-from multiprocessing import Value
+from copy import copy, deepcopy
+from dataclasses import asdict, dataclass, fields, replace
+from functools import lru_cache
+import hashlib
+import json
 import time
-from typing import Optional, Any, List
-
-from treelib import Tree, Node
+from typing import Optional, Any, Dict, List, Tuple
 
 from recoma.datasets.reader import Example
+from recoma.search.prompt_store import PromptRef, prompt_store, resolve_prompt
+
+
+# Rough per-object overheads (in bytes) used to estimate the memory footprint of states
+_NODE_OVERHEAD = 400
+_ENTRY_OVERHEAD = 100
+
 
+class SearchNode:
+    __slots__ = ("identifier", "_is_open", "target", "output", "input_str",
+                 "input_str_for_display", "_tag", "data")
 
-class SearchNode(Node):
     def __init__(self, input_str: str, target_model: str, input_str_for_display=None,
-                 is_open: bool = True, output: Optional[str] = None, data={}):
+                 is_open: bool = True, output: Optional[str] = None, data=None):
         """
         Node in the SearchState tree
         :param input_str: Input string provided by the parent
@@ -18,17 +28,35 @@ class SearchNode(Node):
         :param target_model: Which model should be assigned?
         :param output: Generated output using the target_model
         """
-        super().__init__(data=data)
+        # Index of this node in the SearchState node store. Set when added to a state.
+        self.identifier = None
         self._is_open = is_open
         self.target = target_model
         self.output = output
         self.input_str = input_str
         self.input_str_for_display = input_str_for_display
         self._tag = None
+        self.data = {} if data is None else data
 
     def is_open(self):
         return self._is_open
 
+    def is_memoized(self) -> bool:
+        """
+        Was this node copied from an earlier node with the same input (i.e. its models and prompts
+        were not called again)?
+        """
+        return bool(self.data and self.data.get("memoized"))
+
+    def copy(self) -> "SearchNode":
+        """
+        Create a copy of this node that can be modified without affecting the states that still
+        share this node. The data is copied but the strings are shared.
+        """
+        new_node = copy(self)
+        new_node.data = deepcopy(self.data)
+        return new_node
+
     def target_model(self):
         return self.target
 
@@ -56,20 +84,64 @@ class SearchNode(Node):
             label += "<" + self.target + "> " + display_str + " => ... "
         return label
 
-    def add_input_output_prompt(self, input_str, output):
+    def approx_size(self) -> int:
+        """
+        Approximate memory (in bytes) used by this node, dominated by its strings and prompts
+        """
+        size = _NODE_OVERHEAD
+        for text in (self.input_str, self.input_str_for_display, self.output):
+            if text is not None:
+                size += len(text)
+        for key, value in self.data.items():
+            if key == "prompts":
+                for prompt, outputs in value:
+                    # shared prompt chunks are not counted
+                    prompt_size = prompt.approx_size() if isinstance(prompt, PromptRef) \
+                        else len(prompt)
+                    size += _ENTRY_OVERHEAD + prompt_size + sum(len(output) for output in outputs)
+            else:
+                size += _ENTRY_OVERHEAD
+        return size
+
+    def add_input_output_prompt(self, input_str, output, prefix: Optional[str] = None):
+        """
+        Record the LM input and outputs. The input is kept in the run's PromptStore and the node
+        only holds a reference to it.
+        :param prefix: prefix of the input shared with other prompts (e.g. the rendered few-shot
+        examples), stored only once
+        """
         if self.data is None:
             self.data = {}
         if "prompts" not in self.data:
             self.data["prompts"] = []
         self.data["prompts"].append((
-            input_str,
+            prompt_store.put(input_str, prefix=prefix),
             [x for x in output.outputs]
         ))
 
+    def get_prompts(self) -> List[Tuple[str, List[str]]]:
+        """
+        :return: list of (LM input, outputs) for this node with the inputs resolved to strings
+        """
+        if not self.data or "prompts" not in self.data:
+            return []
+        return [(resolve_prompt(input_str), output_strs)
+                for input_str, output_strs in self.data["prompts"]]
+
+    def resolved_data(self) -> dict:
+        """
+        :return: the node data with the prompts resolved to strings (e.g. for JSON serialization)
+        """
+        if not self.data or "prompts" not in self.data:
+            return self.data
+        return self.data | {"prompts": self.get_prompts()}
+
     def get_input_output_prompts(self):
         output = ""
         if self.data and "prompts" in self.data:
-            for input_str, output_strs in self.data["prompts"]:
+            if self.is_memoized():
+                output += "(memoized: re-used from an earlier node with the same input)\n"
+            for input_str, output_strs in self.get_prompts():
                 output += "Input:\n" + input_str + "\n     ==>\n"
                 for output_str in output_strs:
                     output += "\tOutput: " + output_str + "\n"
@@ -77,32 +149,327 @@ class SearchNode(Node):
         return output
 
 
-class SearchState(Tree):
+# Marker for an open-node cache that needs to be recomputed with a full traversal
+_UNKNOWN_NODE = object()
+
+# Providers whose counters ("<provider>.<model>.<usage field>") are tracked in UsageAccounting
+USAGE_PROVIDERS = ("openai", "litellm")
+
+
+@dataclass
+class UsageTotals:
+    calls: float = 0
+    prompt_tokens: float = 0
+    completion_tokens: float = 0
+    total_tokens: float = 0
+    cost: float = 0
+
+
+_USAGE_FIELDS = frozenset(f.name for f in fields(UsageTotals))
+
+
+@lru_cache(maxsize=4096)
+def parse_usage_key(counter_key: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Parse an LLM usage counter key, e.g. "openai.gpt-4o.prompt_tokens"
+    :return: (provider, model, usage field) or None if the key is not a usage counter
+    """
+    provider, _, rest = counter_key.partition(".")
+    if provider not in USAGE_PROVIDERS:
+        return None
+    model, _, usage_field = rest.rpartition(".")
+    if not model or usage_field not in _USAGE_FIELDS:
+        return None
+    return provider, model, usage_field
+
+
+class UsageAccounting:
+    """
+    Running totals of the LLM usage (calls, tokens and cost) of a search state, overall and per
+    (provider, model). Updated by SearchState.update_counter, so the totals can be read in O(1).
+    """
+    __slots__ = ("total", "by_model")
+
+    def __init__(self):
+        self.total = UsageTotals()
+        self.by_model: Dict[Tuple[str, str], UsageTotals] = {}
+
+    def add(self, counter_key: str, count: float):
+        parsed_key = parse_usage_key(counter_key)
+        if parsed_key is None:
+            return
+        provider, model, usage_field = parsed_key
+        model_totals = self.by_model.get((provider, model))
+        if model_totals is None:
+            model_totals = self.by_model[(provider, model)] = UsageTotals()
+        setattr(model_totals, usage_field, getattr(model_totals, usage_field) + count)
+        setattr(self.total, usage_field, getattr(self.total, usage_field) + count)
+
+    @staticmethod
+    def from_counters(counters: Dict[str, Any]) -> "UsageAccounting":
+        usage = UsageAccounting()
+        for counter_key, count in counters.items():
+            if isinstance(count, (int, float)) and not isinstance(count, bool):
+                usage.add(counter_key, count)
+        return usage
+
+    def copy(self) -> "UsageAccounting":
+        new_usage = UsageAccounting()
+        new_usage.total = replace(self.total)
+        new_usage.by_model = {key: replace(totals) for key, totals in self.by_model.items()}
+        return new_usage
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total": asdict(self.total),
+            "by_model": {provider + "/" + model: asdict(totals)
+                         for (provider, model), totals in self.by_model.items()}
+        }
+
+
+@dataclass(frozen=True)
+class MemoizedSubtree:
+    """
+    Completed subtree re-used for the nodes with the same target model and input in an example
+    """
+    # snapshot of the nodes (see SearchState.subtree_snapshot)
+    nodes: Tuple[Tuple[SearchNode, Optional[int]], ...]
+    # score added to the state by the expansion of the subtree
+    score: float
+
+
+class SearchState:
+    """
+    Tree of SearchNodes representing the reasoning trace. Nodes are identified by their integer
+    index in the node store and the tree structure is kept in parallel lists (parent id, child ids
+    and depth per node), so cloning a state only copies these lists.
+
+    States created via clone() share their nodes with the source state (copy-on-write) and a shared
+    node is only copied when it is modified. Models should therefore only modify nodes returned by
+    get_open_node() or add_next_step(), which are guaranteed to be owned by this state.
+    """
+
+    # If set, every lookup of the cached open node is cross-checked against a full post-order
+    # traversal. Meant for tests.
+    verify_open_node = False
 
     def __init__(self, example: Example = None, score=0, data = {}, init_time = None,
-                 **kwargs):
-        super().__init__(node_class=SearchNode, **kwargs)
+                 usage: Optional[UsageAccounting] = None):
         self.example = example
         self.score = score
         self.data = data
         self._init_time = time.time() if init_time is None else init_time
+        self._nodes: List[SearchNode] = []
+        self._parents: List[Optional[int]] = []
+        self._children: List[Tuple[int, ...]] = []
+        self._depths: List[int] = []
+        # Score of the state when each node was first expanded (None if not expanded yet)
+        self._start_scores: List[Optional[float]] = []
+        # Ids of nodes only referenced by this state, i.e. nodes that can be modified in place
+        self._owned_nids = set()
+        # Id of the first open node in the post-order traversal (None if all nodes are closed)
+        self._open_nid = _UNKNOWN_NODE
+        # Completed subtrees of this example, shared by all the states cloned from this state:
+        # (target model, input_str) -> completed subtree
+        self.subtree_memo: Dict[Tuple[str, str], MemoizedSubtree] = {}
+        # Running totals of the LLM usage counters in data
+        self.usage = UsageAccounting.from_counters(data) if usage is None else usage
+
+    def clone(self, with_tree=True, deep=False):
+        """
+        Clone this search state. By default, the nodes are shared between the two states and only
+        copied on modification, so cloning only copies the per-node id lists.
+        :param with_tree: copy the nodes into the new state
+        :param deep: create a full copy of every node upfront
+        :return: cloned search state
+        """
+        if deep or not with_tree:
+            new_state = SearchState(example=self.example, score=self.score,
+                                    data=deepcopy(self.data), init_time=self._init_time,
+                                    usage=self.usage.copy())
+            new_state.subtree_memo = self.subtree_memo
+            if not with_tree:
+                return new_state
+            new_state._nodes = [node.copy() for node in self._nodes]
+            new_state._owned_nids = set(range(len(self._nodes)))
+        else:
+            # Counters in data are scalar values, so a shallow copy is sufficient
+            new_state = SearchState(example=self.example, score=self.score, data=copy(self.data),
+                                    init_time=self._init_time, usage=self.usage.copy())
+            new_state.subtree_memo = self.subtree_memo
+            new_state._nodes = list(self._nodes)
+            # The nodes are now shared by both states, so neither state can modify them in place
+            self._owned_nids = set()
+        new_state._parents = list(self._parents)
+        # Child id tuples are never modified in place, so they can be shared
+        new_state._children = list(self._children)
+        new_state._depths = list(self._depths)
+        new_state._start_scores = list(self._start_scores)
+        new_state._open_nid = self._open_nid
+        return new_state
+
+    def _own_node(self, nid) -> SearchNode:
+        """
+        Get the node with the given id, copying it first if it is shared with other states
+        """
+        if nid not in self._owned_nids:
+            self._nodes[nid] = self._nodes[nid].copy()
+            self._owned_nids.add(nid)
+        return self._nodes[nid]
+
+    @property
+    def root(self) -> Optional[int]:
+        return 0 if self._nodes else None
+
+    @property
+    def nodes(self) -> dict[int, SearchNode]:
+        """
+        Map from node id to node (read-only view)
+        """
+        return dict(enumerate(self._nodes))
+
+    def __getitem__(self, nid) -> SearchNode:
+        return self._nodes[nid]
 
-    def clone(self, identifier=None, with_tree=True, deep=True):
-        # Reset the open node as the cloning might reset the identifiers
-        return SearchState(example=self.example, score=self.score, data=deepcopy(self.data),
-                           init_time=self._init_time, identifier=identifier, deep=deep,
-                           tree=self if with_tree else None)
+    def __contains__(self, nid) -> bool:
+        return isinstance(nid, int) and 0 <= nid < len(self._nodes)
 
+    def __len__(self):
+        return len(self._nodes)
+
+    def size(self) -> int:
+        return len(self._nodes)
+
+    def get_node(self, nid) -> Optional[SearchNode]:
+        if nid is None or nid not in self:
+            return None
+        return self._nodes[nid]
+
+    def parent(self, nid) -> Optional[SearchNode]:
+        parent_id = self._parents[nid]
+        return None if parent_id is None else self._nodes[parent_id]
+
+    def children(self, nid) -> List[SearchNode]:
+        return [self._nodes[child_id] for child_id in self._children[nid]]
+
+    def depth(self, node=None) -> int:
+        """
+        Get the depth of the input node (or node id). If no node is provided, return the depth of
+        the tree, i.e. the max depth of any node (root is at depth 0).
+        """
+        if node is None:
+            return max(self._depths, default=0)
+        nid = node.identifier if isinstance(node, SearchNode) else node
+        return self._depths[nid]
+
+    def add_node(self, node: SearchNode, parent=None):
+        parent_id = parent.identifier if isinstance(parent, SearchNode) else parent
+        if node.identifier is not None:
+            raise ValueError("Node: {} has already been added to a tree!".format(node.tag))
+        if parent_id is None:
+            if self._nodes:
+                raise ValueError("Tree already has a root node. Parent needed for: {}".format(
+                    node.tag))
+            depth = 0
+        else:
+            if parent_id not in self:
+                raise ValueError("Parent node: {} not found in tree!".format(parent_id))
+            depth = self._depths[parent_id] + 1
+        nid = len(self._nodes)
+        node.identifier = nid
+        self._nodes.append(node)
+        self._parents.append(parent_id)
+        self._children.append(())
+        self._depths.append(depth)
+        self._start_scores.append(None)
+        if parent_id is not None:
+            self._children[parent_id] = self._children[parent_id] + (nid,)
+        self._owned_nids.add(nid)
+        if node.is_open():
+            if parent_id is None or self._open_nid is None or \
+                    (self._open_nid is not _UNKNOWN_NODE and self._open_nid == parent_id):
+                # Every node before the parent (including its earlier children) is closed, so the
+                # new right-most child is now the first open node. Same if no node was open or
+                # this is the root node.
+                self._open_nid = nid
+            else:
+                self._open_nid = _UNKNOWN_NODE
+
+    def approx_size(self) -> int:
+        """
+        Approximate memory footprint (in bytes) of this state. Nodes shared with other states are
+        counted in full, so this is an upper bound on the memory freed by dropping the state (see
+        StateSizeTracker to count the shared nodes of multiple states only once).
+        """
+        return self._approx_size_without_nodes() + \
+            sum(node.approx_size() for node in self._nodes)
+
+    def _approx_size_without_nodes(self) -> int:
+        # the data and the per-node id lists
+        return _ENTRY_OVERHEAD * (len(self.data) + 4 * len(self._nodes))
+
+    def elapsed_time(self) -> float:
+        """
+        Seconds since the search for this example started
+        """
+        return time.time() - self._init_time
 
     def update_counter(self, counter_key: str, count: float):
         if counter_key not in self.data:
             self.data[counter_key] = 0
         self.data[counter_key] += count
+        self.usage.add(counter_key, count)
 
     def get_open_node(self) -> Optional[SearchNode]:
-        # TODO Cache the depth first open node value. This is tricky because any non-local change
-        # can change the first open node
-        return self.get_depth_first_open_node()
+        """
+        Get the first open node in the post-order traversal. Models modify this node, so it is
+        always owned by this state.
+        """
+        open_nid = self._get_open_nid()
+        if open_nid is None:
+            return None
+        return self._own_node(open_nid)
+
+    def _get_open_nid(self):
+        """
+        Get the id of the first open node in post-order using the cached value. Nodes can only be
+        closed (never re-opened) and new open nodes are handled in add_node, so the cached node is
+        still the first open node unless it has been closed. In that case, every node before it is
+        closed too and we only need to move forward to the next open node in post-order.
+        """
+        if self._open_nid is _UNKNOWN_NODE:
+            open_node = self.get_depth_first_open_node()
+            self._open_nid = open_node.identifier if open_node is not None else None
+        elif self._open_nid is not None and not self._nodes[self._open_nid].is_open():
+            next_nid = self._postorder_successor(self._open_nid)
+            while next_nid is not None and not self._nodes[next_nid].is_open():
+                next_nid = self._postorder_successor(next_nid)
+            self._open_nid = next_nid
+        if self.verify_open_node:
+            open_node = self.get_depth_first_open_node()
+            expected_nid = open_node.identifier if open_node is not None else None
+            if expected_nid != self._open_nid:
+                raise ValueError("Cached open node: {} does not match the open node: {} in "
+                                 "tree:\n{}".format(self._open_nid, expected_nid,
+                                                    self.to_str_tree()))
+        return self._open_nid
+
+    def _postorder_successor(self, nid):
+        """
+        Get the id of the node visited after the input node in the post-order traversal, i.e. the
+        left-most leaf of the next sibling or the parent if there is no next sibling.
+        """
+        parent_id = self._parents[nid]
+        if parent_id is None:
+            return None
+        siblings = self._children[parent_id]
+        sibling_idx = siblings.index(nid)
+        if sibling_idx + 1 == len(siblings):
+            return parent_id
+        next_nid = siblings[sibling_idx + 1]
+        while self._children[next_nid]:
+            next_nid = self._children[next_nid][0]
+        return next_nid
 
     def get_depth_first_open_node(self) -> Optional[SearchNode]:
         for node_id in self.postorder_traversal():
@@ -111,16 +478,74 @@ class SearchState(Tree):
         return None
 
     def has_open_node(self):
-        return self.get_open_node() is not None
+        return self._get_open_nid() is not None
 
     def get_depth_nth_node(self, nth: int):
-        return self[list(self.expand_tree(mode=self.DEPTH, sorting=False))[nth]]
+        return self[list(self.preorder_traversal())[nth]]
 
     def update_score(self, score):
         self.score += score
 
+    def record_expansion_start(self, nid):
+        """
+        Record the score of this state when the node is expanded for the first time (see
+        subtree_score)
+        """
+        if self._start_scores[nid] is None:
+            self._start_scores[nid] = self.score
+
+    def subtree_score(self, nid) -> Optional[float]:
+        """
+        Score added to this state by the expansion of the (completed) subtree of the node. Only the
+        nodes in the subtree are expanded from the first expansion of the node till it is closed,
+        since it is the first open node in the post-order traversal.
+        :return: the score or None if the first expansion of the node was not recorded
+        """
+        start_score = self._start_scores[nid]
+        return None if start_score is None else self.score - start_score
+
     def to_str_tree(self) -> str:
-        return self.show(stdout=False, sorting=False) or ""
+        """
+        Render the tree as text, one node tag per line (same format as treelib's show())
+        """
+        if self.root is None:
+            return ""
+        lines = [self._nodes[self.root].tag]
+        stack = []
+        self._push_children_for_display(stack, self.root, "")
+        while stack:
+            nid, prefix, is_last = stack.pop()
+            lines.append(prefix + ("└── " if is_last else "├── ") + self._nodes[nid].tag)
+            self._push_children_for_display(stack, nid, prefix + ("    " if is_last else "│   "))
+        return "\n".join(lines) + "\n"
+
+    def _push_children_for_display(self, stack, nid, prefix):
+        children_ids = self._children[nid]
+        # push in reverse so that the left-most child is displayed first
+        for idx in range(len(children_ids) - 1, -1, -1):
+            stack.append((children_ids[idx], prefix, idx == len(children_ids) - 1))
+
+    def to_dict(self, nid=None, sort=True, reverse=False, with_data=False):
+        """
+        Nested dictionary representation of the tree (same format as treelib's to_dict())
+        """
+        nid = self.root if nid is None else nid
+        node = self._nodes[nid]
+        tree_dict = {node.tag: {"children": []}}
+        if with_data:
+            tree_dict[node.tag]["data"] = node.resolved_data()
+        children = self.children(nid)
+        if sort:
+            children.sort(key=lambda x: x.tag, reverse=reverse)
+        for child in children:
+            tree_dict[node.tag]["children"].append(
+                self.to_dict(child.identifier, sort=sort, reverse=reverse, with_data=with_data))
+        if len(tree_dict[node.tag]["children"]) == 0:
+            tree_dict = node.tag if not with_data else {node.tag: {"data": node.resolved_data()}}
+        return tree_dict
+
+    def to_json(self, with_data=False, sort=True, reverse=False):
+        return json.dumps(self.to_dict(with_data=with_data, sort=sort, reverse=reverse))
 
     def all_input_output_prompts(self) -> str:
         output_str = ""
@@ -132,19 +557,14 @@ class SearchState(Tree):
 
     def get_children_ids(self, parent_id):
         """
-        A wrapper around the non-intuitive is_branch function to get children
+        Get the ids of the children of the input node id
         :param parent_id: parent node id
         :return: list of children node ids (ordered left-to-right)
         """
-        return self.is_branch(parent_id)
+        return list(self._children[parent_id])
 
     def get_children(self, parent_node: SearchNode) -> List[SearchNode]:
-        result = []
-        for nid in self.get_children_ids(parent_node.identifier):
-            if self.get_node(nid) is None:
-                raise ValueError("Node: {} not found in tree!".format(nid))
-            result.append(self.get_node(nid))
-        return result
+        return self.children(parent_node.identifier)
 
     def add_next_step(self, next_step_input: str,
                       next_step_model: str,
@@ -162,42 +582,124 @@ class SearchState(Tree):
         return new_node
 
     def postorder_traversal(self):
-        node_stack = [self.root]
-        # for debugging, to remove
-        popped_nids = set()
-        while len(node_stack):
-            popped_id = node_stack.pop()
-            children_ids = self.get_children_ids(popped_id)
-
-            if children_ids:
-                assert popped_id not in popped_nids, self.nodes[popped_id].tag
-                node_stack.append(popped_id)
-                for child in children_ids:
-                    assert child not in popped_nids, self.nodes[child].tag
-                node_stack.extend(reversed(children_ids))
+        if self.root is None:
+            return
+        # (node id, children already pushed?)
+        node_stack = [(self.root, False)]
+        while node_stack:
+            nid, expanded = node_stack.pop()
+            children_ids = self._children[nid]
+            if expanded or not children_ids:
+                yield nid
             else:
+                node_stack.append((nid, True))
+                for child_idx in range(len(children_ids) - 1, -1, -1):
+                    node_stack.append((children_ids[child_idx], False))
 
-                yield popped_id
-                popped_nids.add(popped_id)
-                if len(node_stack) == 0:
-                    break
-                curr_children = self.get_children_ids(node_stack[-1])
-                if len(curr_children) == 0:
-                    continue
-                right_most_child = curr_children[-1]
-                while right_most_child == popped_id:
-                    popped_id = node_stack.pop()
-                    yield popped_id
-                    popped_nids.add(popped_id)
-                    if len(node_stack) == 0:
-                        break
-                    curr_children = self.get_children_ids(node_stack[-1])
-                    if len(curr_children) == 0:
-                        break
-                    right_most_child = curr_children[-1]
+    def preorder_traversal(self, nid=None):
+        """
+        Pre-order traversal of the subtree under the input node id (default: the whole tree)
+        """
+        if self.root is None:
+            return
+        node_stack = [self.root if nid is None else nid]
+        while node_stack:
+            nid = node_stack.pop()
+            yield nid
+            children_ids = self._children[nid]
+            for child_idx in range(len(children_ids) - 1, -1, -1):
+                node_stack.append(children_ids[child_idx])
+
+    def is_subtree_closed(self, nid) -> bool:
+        """
+        Are the input node and all its descendants closed?
+        """
+        return not any(self._nodes[sub_nid].is_open() for sub_nid in self.preorder_traversal(nid))
+
+    def subtree_snapshot(self, nid) -> Tuple[Tuple[SearchNode, Optional[int]], ...]:
+        """
+        Copy of the subtree rooted at the node, independent of this state (e.g. to re-use it in
+        other states without keeping this state alive)
+        :return: tuple of (node copy, index of its parent in the tuple) in pre-order, where the
+        first entry is the root of the subtree (with parent None)
+        """
+        snapshot = []
+        snapshot_idx = {}
+        for sub_nid in self.preorder_traversal(nid):
+            new_node = self._nodes[sub_nid].copy()
+            new_node.identifier = None
+            parent_nid = self._parents[sub_nid]
+            snapshot_idx[sub_nid] = len(snapshot)
+            snapshot.append((new_node, snapshot_idx[parent_nid] if sub_nid != nid else None))
+        return tuple(snapshot)
+
+    def add_subtree_snapshot(self, snapshot: Tuple[Tuple[SearchNode, Optional[int]], ...],
+                             parent_nid: int, data_update: Optional[Dict[str, Any]] = None):
+        """
+        Add a copy of the descendants of the snapshot root (see subtree_snapshot) as the
+        descendants of the parent node in this state
+        :param data_update: entries added to the data of every copied node
+        """
+        new_nids = [parent_nid]
+        for node, snapshot_parent in snapshot[1:]:
+            new_node = node.copy()
+            if data_update:
+                new_node.data.update(data_update)
+            self.add_node(new_node, parent=new_nids[snapshot_parent])
+            new_nids.append(new_node.identifier)
+
+    def canonical_key(self) -> str:
+        """
+        Hash of the content of the tree that determines how the search proceeds from this state,
+        i.e. the shape of the tree and the target model, input, output and status of every node.
+        States with the same key are equivalent even if they were generated by different branches
+        of the search (the score and the metadata are ignored).
+        """
+        items = [(self._depths[nid], node.target, node.input_str, node.output, node.is_open())
+                 for nid in self.preorder_traversal()
+                 for node in (self._nodes[nid],)]
+        return hashlib.sha1(json.dumps(items, default=str).encode("utf-8")).hexdigest()
 
     # For heapq
     def __lt__(self, other):
         if self.score < other.score:
             return True
         return False
+
+
+class StateSizeTracker:
+    """
+    Approximate memory footprint (in bytes) of a set of states, e.g. the states in the search heap.
+    Nodes shared by multiple states (copy-on-write) are only counted once. The states must not be
+    modified while they are tracked.
+    """
+
+    def __init__(self):
+        self.total = 0
+        # id of a tracked state -> its size without the nodes
+        self._state_sizes: Dict[int, int] = {}
+        # id of a node -> [number of tracked states referencing it, size of the node]
+        self._node_refs: Dict[int, List[int]] = {}
+
+    def add(self, state: SearchState):
+        state_size = state._approx_size_without_nodes()
+        self._state_sizes[id(state)] = state_size
+        self.total += state_size
+        for node in state._nodes:
+            node_ref = self._node_refs.get(id(node))
+            if node_ref is None:
+                node_size = node.approx_size()
+                self._node_refs[id(node)] = [1, node_size]
+                self.total += node_size
+            else:
+                node_ref[0] += 1
+
+    def remove(self, state: SearchState):
+        self.total -= self._state_sizes.pop(id(state))
+        for node in state._nodes:
+            node_ref = self._node_refs[id(node)]
+            node_ref[0] -= 1
+            if node_ref[0] == 0:
+                # no other tracked state references the node, so it is freed with the state
+                del self._node_refs[id(node)]
+                self.total -= node_ref[1]
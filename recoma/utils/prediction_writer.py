@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Set
+
+from recoma.search.deadline import RUN_DEADLINE
+from recoma.search.search import ExamplePrediction
+
+logger = logging.getLogger(__name__)
+
+
+def prediction_to_json(x: ExamplePrediction) -> Dict[str, Any]:
+    """
+    Convert the example prediction into the JSON dictionary written to all_data.jsonl, i.e. the
+    input example fields along with the prediction, correctness label (using exact match) and the
+    metadata from the final state.
+    """
+    metadata_json = {}
+    try:
+        pred_json = json.loads(x.prediction)
+        if not isinstance(pred_json, list) and not isinstance(pred_json, dict):
+            pred_json = x.prediction
+        elif isinstance(pred_json, dict):
+            if "metadata" in pred_json:
+                metadata_json = pred_json.pop("metadata")
+            if "answer" in pred_json:
+                pred_json = pred_json["answer"]
+    except Exception:
+        pred_json = x.prediction
+    all_data_dict = dict(x.example.__dict__)
+    all_data_dict["unique_id"] = x.example.unique_id
+    all_data_dict["predicted"] = pred_json
+    if x.final_state and x.final_state.data:
+        metadata_json = x.final_state.data | metadata_json
+    if x.final_state and x.final_state.usage.by_model:
+        metadata_json["usage"] = x.final_state.usage.to_dict()
+    if x.error:
+        metadata_json["error"] = x.error
+    if isinstance(x.example.label, list) and len(x.example.label) == 1:
+        gold_answer = x.example.label[0]
+    else:
+        gold_answer = x.example.label
+    score = 1 if (x.prediction == gold_answer) else 0
+    all_data_dict["correct"] = str(score)
+    if metadata_json:
+        all_data_dict["metadata"] = metadata_json
+    return all_data_dict
+
+
+def read_all_data(all_data_file: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the predictions from an all_data.jsonl file, skipping incomplete lines (e.g. from a
+    crashed run). If an example appears multiple times, the last entry is used.
+    :return: map from unique_id to the example's JSON dictionary (in file order)
+    """
+    all_data = {}
+    if not os.path.exists(all_data_file):
+        return all_data
+    with open(all_data_file, "r") as input_fp:
+        for line in input_fp:
+            try:
+                line_json = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping incomplete line in {}: {}".format(all_data_file,
+                                                                          line[:100]))
+                continue
+            unique_id = line_json.get("unique_id", line_json.get("qid"))
+            # move to the end
+            all_data.pop(unique_id, None)
+            all_data[unique_id] = line_json
+    return all_data
+
+
+# Numeric metadata fields that are gauges (e.g. high-water marks) rather than counters, matched by
+# suffix (e.g. "litellm.<model>.concurrency_limit"). These are aggregated across examples by their
+# max instead of their sum.
+GAUGE_METADATA_KEYS = {"concurrency_limit", "search.heap_high_water",
+                       "search.heap_high_water_bytes"}
+
+
+def is_gauge(key: str) -> bool:
+    return any(key == gauge_key or key.endswith("." + gauge_key)
+               for gauge_key in GAUGE_METADATA_KEYS)
+
+
+def aggregate_counters(all_data: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Sum the numeric metadata fields (e.g. token counters) across all the examples. Gauges (see
+    GAUGE_METADATA_KEYS) are aggregated by their max.
+    """
+    counters: Dict[str, float] = {}
+    for line_json in all_data.values():
+        for key, value in line_json.get("metadata", {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if is_gauge(key):
+                    counters[key] = max(counters.get(key, value), value)
+                else:
+                    counters[key] = counters.get(key, 0) + value
+    return counters
+
+
+def aggregate_usage(all_data: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Sum the total LLM usage (calls, tokens and cost) across all the examples
+    """
+    usage_totals: Dict[str, float] = {}
+    for line_json in all_data.values():
+        usage_json = line_json.get("metadata", {}).get("usage", {}).get("total", {})
+        for key, value in usage_json.items():
+            usage_totals[key] = usage_totals.get(key, 0) + value
+    return usage_totals
+
+
+def summarize_all_data(all_data: Dict[str, Dict[str, Any]], output_dir: str):
+    """
+    Write predictions.json (unique_id -> prediction), counters.json (aggregated numeric metadata) and
+    print the EM score for the predictions read from all_data.jsonl
+    """
+    prediction_dump = {}
+    total_score = 0
+    for unique_id, line_json in all_data.items():
+        prediction_dump[unique_id] = line_json["predicted"]
+        total_score += int(line_json["correct"])
+    with open(output_dir + "/predictions.json", "w") as output_fp:
+        json.dump(prediction_dump, output_fp)
+    counters = aggregate_counters(all_data)
+    with open(output_dir + "/counters.json", "w") as output_fp:
+        json.dump(counters, output_fp, indent=2)
+    usage_totals = aggregate_usage(all_data)
+    if usage_totals:
+        print("LLM usage: {:g} calls, {:g} tokens ({:g} prompt + {:g} completion), cost: ${:.4f}"
+              .format(usage_totals.get("calls", 0), usage_totals.get("total_tokens", 0),
+                      usage_totals.get("prompt_tokens", 0),
+                      usage_totals.get("completion_tokens", 0), usage_totals.get("cost", 0)))
+    for key, num_hits in counters.items():
+        if key.endswith("cache_hit"):
+            num_misses = counters.get(key[:-len("hit")] + "miss", 0)
+            print("{} hit rate: {:.1f}% ({}/{})".format(
+                key[:-len("_hit")], 100 * num_hits / (num_hits + num_misses), num_hits,
+                num_hits + num_misses))
+    num_examples = len(all_data)
+    print("EM Score: {} ({}/{})".format(100 * total_score / num_examples if num_examples else 0,
+                                        total_score, num_examples))
+
+
+class PredictionWriter:
+    """
+    Streams example predictions to all_data.jsonl (and the prompt dumps) as soon as each example
+    is solved, so a crashed run only loses the examples in flight. predictions.json and the EM
+    score are computed from all_data.jsonl at the end.
+    """
+
+    def __init__(self, output_dir: str, dump_prompts: bool = False, resume: bool = False):
+        """
+        :param output_dir: output directory
+        :param dump_prompts: also dump the input prompts -> output of each example
+        :param resume: keep the successfully completed examples from an existing all_data.jsonl
+        (failed, incomplete or run-deadline entries are dropped so that they can be re-run)
+        """
+        self.output_dir = output_dir
+        self.dump_prompts = dump_prompts
+        self.all_data_file = output_dir + "/all_data.jsonl"
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        if dump_prompts:
+            Path(output_dir + "/prompts_dump").mkdir(parents=True, exist_ok=True)
+        self.completed_ids: Set[str] = set()
+        if resume:
+            # examples cut short by the deadline of the previous run are also re-run
+            completed = {unique_id: line_json
+                         for unique_id, line_json in read_all_data(self.all_data_file).items()
+                         if "error" not in line_json.get("metadata", {}) and
+                         line_json.get("metadata", {}).get("timeout") != RUN_DEADLINE}
+            self.completed_ids = set(completed.keys())
+            # Re-write the file without the dropped lines before appending to it
+            tmp_file = self.all_data_file + ".tmp"
+            with open(tmp_file, "w") as output_fp:
+                for line_json in completed.values():
+                    output_fp.write(json.dumps(line_json) + "\n")
+            os.replace(tmp_file, self.all_data_file)
+            logger.info("Resuming with {} completed examples".format(len(self.completed_ids)))
+            self._all_data_fp = open(self.all_data_file, "a")
+        else:
+            self._all_data_fp = open(self.all_data_file, "w")
+
+    def write(self, x: ExamplePrediction):
+        if self.dump_prompts and x.final_state:
+            with open(self.output_dir + "/prompts_dump/" + x.example.qid + "_prompts.txt",
+                      "w") as output_fp:
+                output_fp.write(x.final_state.all_input_output_prompts())
+        self._all_data_fp.write(json.dumps(prediction_to_json(x)) + "\n")
+        self._all_data_fp.flush()
+
+    def close(self):
+        self._all_data_fp.close()
+
+    def summarize(self):
+        summarize_all_data(read_all_data(self.all_data_file), self.output_dir)
@@ -0,0 +1,87 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from recoma.search.state import SearchState
+from recoma.utils.state_renderer import StateRenderer
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRenderWriter:
+    """
+    Renders search states and writes them to files on a background thread, so that the search loop
+    never blocks on rendering or disk I/O. Only the latest state submitted for a file is kept, i.e.
+    states that are superseded before the writer gets to them are never rendered.
+    """
+
+    def __init__(self, renderers: List[StateRenderer]):
+        self.renderers = renderers
+        # file prefix -> latest state to be written (in submission order)
+        self._pending: "OrderedDict[str, SearchState]" = OrderedDict()
+        self._num_writing = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def submit(self, file_prefix: str, state: SearchState):
+        """
+        Schedule the state to be rendered to file_prefix + renderer suffix + extension. The state
+        must not be modified after submission (submit a clone if the search continues to modify it).
+        """
+        with self._condition:
+            if self._closed:
+                raise ValueError("Render writer has already been closed!")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="render-writer",
+                                                daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            # Replace (and move to the end) any older state for the same file
+            self._pending.pop(file_prefix, None)
+            self._pending[file_prefix] = state
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Block until every submitted state has been written
+        """
+        with self._condition:
+            while self._pending or self._num_writing:
+                self._condition.wait()
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                file_prefix, state = self._pending.popitem(last=False)
+                self._num_writing += 1
+            try:
+                self.write(file_prefix, state)
+            except Exception:
+                logger.exception("Failed to render state to: {}".format(file_prefix))
+            finally:
+                # do not keep the state (and its prompts) alive while waiting for the next one
+                state = None
+                with self._condition:
+                    self._num_writing -= 1
+                    self._condition.notify_all()
+
+    def write(self, file_prefix: str, state: SearchState):
+        for renderer in self.renderers:
+            filename = file_prefix + renderer.special_suffix + "." + renderer.output_format
+            with open(filename, "w") as fp:
+                fp.write(renderer.output(state))
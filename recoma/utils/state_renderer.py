@@ -183,6 +183,8 @@ details.small summary:before {
                 summary += "<u>&lt;" + node.target + "&gt;</u> "
             else:
                 summary += "<span class=\"model_name\">" + node.target + "</span>"
+                if node.is_memoized():
+                    summary += " <i>(memoized)</i> "
             if node.input_str_for_display:
                 summary += node.input_str_for_display + " => "
             if node.output is not None:
@@ -196,7 +198,7 @@ details.small summary:before {
             summary += """\n<details class="small">\n  <summary>\nOutput\n</summary>\n{}</details>\n""".format(self.clean_text(node.output))
         if "prompts" in node.data:
             details = ""
-            for input_str, output_strs in node.data["prompts"]:
+            for input_str, output_strs in node.get_prompts():
                 details += "<b>Input:</b>\n<br>\n" + input_str.replace("\n", "<br>") + "\n<br>\n"
                 for output_str in output_strs:
                     details += "&nbsp;<b>Output:</b>\n<br>\n" + output_str.replace("\n",
@@ -286,6 +288,8 @@ class TreeRenderer(StateRenderer):
                 summary += "<u>&lt;" + node.target + "&gt;</u> "
             else:
                 summary += "<span class=\"model_name\">" + node.target + "</span>"
+                if node.is_memoized():
+                    summary += " <i>(memoized)</i> "
             if node.input_str_for_display:
                 summary += node.input_str_for_display + " => "
             if node.output is not None:
@@ -294,7 +298,7 @@ class TreeRenderer(StateRenderer):
                 summary += " ... "
         if "prompts" in node.data:
             details = ""
-            for input_str, output_strs in node.data["prompts"]:
+            for input_str, output_strs in node.get_prompts():
                 details += "<b>Input:</b>\n<br>\n" + input_str.replace("\n", "<br>") + "\n<br>\n"
                 for output_str in output_strs:
                     details += "&nbsp;<b>Output:</b>\n<br>\n" + output_str.replace("\n",
@@ -361,6 +365,8 @@ class OldStateRenderer(StateRenderer):
                 summary += "<u>&lt;" + node.target + "&gt;</u> "
             else:
                 summary += "<span class=\"model_name\">" + node.target + "</span>"
+                if node.is_memoized():
+                    summary += " <i>(memoized)</i> "
             if node.input_str_for_display:
                 summary += node.input_str_for_display + " => "
             if node.output is not None:
@@ -369,7 +375,7 @@ class OldStateRenderer(StateRenderer):
                 summary += " ... "
         details = ""
         if "prompts" in node.data:
-            for input_str, output_strs in node.data["prompts"]:
+            for input_str, output_strs in node.get_prompts():
                 details += "<b>Input:</b>\n<br>\n" + input_str.replace("\n", "<br>") + "\n<br>\n"
                 for output_str in output_strs:
                     details += "&nbsp;<b>Output:</b>\n<br>\n" + output_str.replace("\n",
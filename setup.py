@@ -52,6 +52,7 @@ setup(
     entry_points={  # Optional
         "console_scripts": [
             "recoma.run_inference=recoma.run_inference:main",
+            "recoma.merge_predictions=recoma.merge_predictions:main",
         ],
     }
 )
@@ -0,0 +1,194 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from recoma.models.core.request_coalescer import RequestCoalescer
+from recoma.search.deadline import DeadlineExceeded, check_deadline, deadline_scope
+
+
+def run_in_thread(function, deadline=None):
+    """
+    Run the function in a new thread (within a deadline scope) and collect its result or exception
+    """
+    outcome = {}
+
+    def target():
+        with deadline_scope(*(deadline or (None, None))):
+            try:
+                outcome["result"] = function()
+            except BaseException as e:
+                outcome["exception"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, outcome
+
+
+def slow_call(calls, duration=0.2, result="output"):
+    def function():
+        calls.append(threading.current_thread().name)
+        time.sleep(duration)
+        return result
+    return function
+
+
+def test_concurrent_calls_are_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+    threads = [run_in_thread(lambda: coalescer.call("key", slow_call(calls))) for _ in range(4)]
+    for thread, _ in threads:
+        thread.join()
+    assert len(calls) == 1
+    outcomes = [outcome["result"] for _, outcome in threads]
+    assert all(result == "output" for result, _ in outcomes)
+    assert sorted(is_shared for _, is_shared in outcomes) == [False, True, True, True]
+
+
+def test_different_keys_are_not_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+    threads = [run_in_thread(lambda key=key: coalescer.call(key, slow_call(calls)))
+               for key in ["a", "b"]]
+    for thread, _ in threads:
+        thread.join()
+    assert len(calls) == 2
+
+
+def test_request_error_is_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    def failing_call():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError("bad request")
+
+    threads = [run_in_thread(lambda: coalescer.call("key", failing_call)) for _ in range(3)]
+    for thread, _ in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(isinstance(outcome["exception"], ValueError) for _, outcome in threads)
+
+
+def test_leader_deadline_is_not_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    def call_with_deadline_check():
+        calls.append(1)
+        time.sleep(0.3)
+        check_deadline()
+        return "output"
+
+    leader, leader_outcome = run_in_thread(
+        lambda: coalescer.call("key", call_with_deadline_check),
+        deadline=(time.monotonic() + 0.1, "example"))
+    time.sleep(0.05)
+    follower, follower_outcome = run_in_thread(
+        lambda: coalescer.call("key", call_with_deadline_check))
+    leader.join()
+    follower.join()
+    assert isinstance(leader_outcome["exception"], DeadlineExceeded)
+    # the follower (without a deadline) makes the call again instead of timing out
+    assert follower_outcome["result"] == ("output", False)
+    assert len(calls) == 2
+
+
+def test_follower_stops_at_its_deadline():
+    coalescer = RequestCoalescer()
+    calls = []
+    leader, leader_outcome = run_in_thread(
+        lambda: coalescer.call("key", slow_call(calls, duration=0.5)))
+    time.sleep(0.05)
+    start_time = time.monotonic()
+    follower, follower_outcome = run_in_thread(
+        lambda: coalescer.call("key", slow_call(calls, duration=0.5)),
+        deadline=(time.monotonic() + 0.1, "example"))
+    follower.join()
+    assert time.monotonic() - start_time < 0.4
+    assert isinstance(follower_outcome["exception"], DeadlineExceeded)
+    leader.join()
+    assert leader_outcome["result"] == ("output", False)
+    assert len(calls) == 1
+
+
+async def async_call(calls, duration=0.2, result="output"):
+    calls.append(1)
+    await asyncio.sleep(duration)
+    check_deadline()
+    return result
+
+
+def test_async_concurrent_calls_are_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def run():
+        return await asyncio.gather(*[coalescer.acall("key", lambda: async_call(calls))
+                                      for _ in range(4)])
+
+    outcomes = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(is_shared for _, is_shared in outcomes) == [False, True, True, True]
+
+
+def test_async_leader_deadline_is_not_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def leader():
+        with deadline_scope(time.monotonic() + 0.1, "example"):
+            return await coalescer.acall("key", lambda: async_call(calls, duration=0.3))
+
+    async def follower():
+        await asyncio.sleep(0.05)
+        return await coalescer.acall("key", lambda: async_call(calls, duration=0.3))
+
+    async def run():
+        return await asyncio.gather(asyncio.create_task(leader()),
+                                    asyncio.create_task(follower()), return_exceptions=True)
+
+    leader_outcome, follower_outcome = asyncio.run(run())
+    assert isinstance(leader_outcome, DeadlineExceeded)
+    assert follower_outcome == ("output", False)
+    assert len(calls) == 2
+
+
+def test_async_cancelled_leader_is_not_shared():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def run():
+        leader = asyncio.create_task(coalescer.acall("key", lambda: async_call(calls)))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(coalescer.acall("key", lambda: async_call(calls)))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == ("output", False)
+    assert len(calls) == 2
+
+
+def test_async_follower_stops_at_its_deadline():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def follower():
+        await asyncio.sleep(0.05)
+        with deadline_scope(time.monotonic() + 0.1, "example"):
+            return await coalescer.acall("key", lambda: async_call(calls, duration=0.5))
+
+    async def run():
+        return await asyncio.gather(
+            asyncio.create_task(coalescer.acall("key", lambda: async_call(calls, duration=0.5))),
+            asyncio.create_task(follower()), return_exceptions=True)
+
+    leader_outcome, follower_outcome = asyncio.run(run())
+    assert leader_outcome == ("output", False)
+    assert isinstance(follower_outcome, DeadlineExceeded)
+    assert len(calls) == 1
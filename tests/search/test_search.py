@@ -0,0 +1,51 @@
+from collections import Counter
+
+from recoma.datasets.reader import QAExample
+from recoma.models.core.base_model import BaseModel
+from recoma.models.core.generator import GenerationOutputs
+from recoma.search.search import BestFirstSearch
+from recoma.search.state import SearchState
+
+
+class DuplicateSamplingModel(BaseModel):
+    """
+    Model that samples the same output twice with the given scores, i.e. two equivalent states
+    """
+
+    def __init__(self, calls: Counter, scores, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = calls
+        self.scores = scores
+
+    def generate_output(self, state: SearchState) -> GenerationOutputs:
+        input_str = state.get_open_node().input_str
+        self.calls[input_str] += 1
+        return GenerationOutputs(outputs=[input_str + "!", input_str + "!"], scores=self.scores)
+
+
+def run_search(**kwargs):
+    calls = Counter()
+    model_list = {
+        # the worse copy is pushed first and popped before the better copy's children
+        "first": DuplicateSamplingModel(calls, scores=[1, 0], next_model="second"),
+        "second": DuplicateSamplingModel(calls, scores=[5, 5]),
+    }
+    search = BestFirstSearch(model_list=model_list, start_model="first", **kwargs)
+    example = QAExample(qid="1", question="q", gold_answer=None, paras=[])
+    return search.predict(example), calls
+
+
+def test_worse_equivalent_state_is_not_expanded():
+    prediction, calls = run_search(use_transposition_table=True)
+    final_state = prediction.final_state
+    assert final_state.score == 5
+    # the worse copy of the state after the first model is skipped when popped and the equal copy
+    # of the final state is not pushed
+    assert calls == Counter({"q": 1, "q!": 1})
+    assert final_state.data["search.skipped_expansions"] == 2
+
+
+def test_equivalent_states_are_expanded_without_transposition_table():
+    prediction, calls = run_search()
+    assert prediction.final_state.score == 5
+    assert calls["q!"] == 2
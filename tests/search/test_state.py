@@ -0,0 +1,135 @@
+import pytest
+
+from recoma.datasets.reader import QAExample
+from recoma.models.core.base_model import BaseModel
+from recoma.models.core.generator import GenerationOutputs
+from recoma.search.search import BestFirstSearch
+from recoma.search.state import SearchState
+
+
+@pytest.fixture(autouse=True)
+def verify_open_node(monkeypatch):
+    # cross-check the cached open node against a full post-order traversal on every lookup
+    monkeypatch.setattr(SearchState, "verify_open_node", True)
+
+
+def expected_open_nid(state: SearchState):
+    for nid in state.postorder_traversal():
+        if state[nid].is_open():
+            return nid
+    return None
+
+
+def assert_open_node(state: SearchState):
+    open_node = state.get_open_node()
+    assert (open_node.identifier if open_node is not None else None) == expected_open_nid(state)
+
+
+def build_state():
+    state = SearchState(example=None, data={})
+    state.add_next_step("root", "controller", None)
+    return state
+
+
+def test_add_next_step_and_close():
+    state = build_state()
+    root = state.get_open_node()
+    assert_open_node(state)
+    first = state.add_next_step("q1", "qa", root)
+    assert_open_node(state)
+    assert state.get_open_node() is first
+    first.close(output="a1")
+    assert_open_node(state)
+    assert state.get_open_node().identifier == root.identifier
+    second = state.add_next_step("q2", "qa", root)
+    grandchild = state.add_next_step("q2.1", "qa", second)
+    assert state.get_open_node() is grandchild
+    grandchild.close(output="a2.1")
+    assert_open_node(state)
+    state.get_open_node().close(output="a2")
+    assert_open_node(state)
+    state.get_open_node().close(output="done")
+    assert state.get_open_node() is None
+    assert_open_node(state)
+
+
+def test_add_open_node_after_open_node():
+    state = build_state()
+    root = state.get_open_node()
+    first = state.add_next_step("q1", "qa", root)
+    # a second open child of the root is visited after the first one
+    state.add_next_step("q2", "qa", root)
+    assert_open_node(state)
+    assert state.get_open_node() is first
+    first.close(output="a1")
+    assert_open_node(state)
+    assert state.get_open_node().input_str == "q2"
+
+
+def test_clones_sharing_nodes():
+    state = build_state()
+    root = state.get_open_node()
+    state.add_next_step("q1", "qa", root)
+    clones = [state.clone() for _ in range(3)]
+    clones[0].get_open_node().close(output="a1")
+    assert_open_node(clones[0])
+    # the other states share the node, so they are not affected by the close
+    for other_state in [state] + clones[1:]:
+        assert other_state.get_open_node().input_str == "q1"
+        assert_open_node(other_state)
+    clones[1].add_next_step("q1.1", "qa", clones[1].get_open_node())
+    assert_open_node(clones[1])
+    assert clones[2].get_open_node().input_str == "q1"
+    deep_clone = clones[1].clone(deep=True)
+    deep_clone.get_open_node().close(output="a1.1")
+    assert_open_node(deep_clone)
+    assert clones[1].get_open_node().input_str == "q1.1"
+
+
+class NestedController(BaseModel):
+    """
+    Controller that asks its sub-model num_steps questions and then closes with their outputs
+    """
+
+    def __init__(self, sub_model: str, num_steps: int, **kwargs):
+        super().__init__(**kwargs)
+        self.sub_model = sub_model
+        self.num_steps = num_steps
+
+    def __call__(self, state: SearchState):
+        new_state = state.clone()
+        current_node = new_state.get_open_node()
+        children = new_state.get_children(current_node)
+        if len(children) < self.num_steps:
+            new_state.add_next_step(next_step_input="{}.{}".format(current_node.input_str,
+                                                                   len(children)),
+                                    next_step_model=self.sub_model,
+                                    current_step_node=current_node)
+        else:
+            current_node.close(output=" ".join(child.output for child in children))
+        return [new_state]
+
+
+class SamplingModel(BaseModel):
+    """
+    Leaf model that returns two outputs, i.e. two states sharing all the other nodes
+    """
+
+    def generate_output(self, state: SearchState) -> GenerationOutputs:
+        input_str = state.get_open_node().input_str
+        return GenerationOutputs(outputs=[input_str + "a", input_str + "b"], scores=[0, 1])
+
+
+def test_nested_controllers():
+    model_list = {
+        "outer": NestedController(sub_model="inner", num_steps=2),
+        "inner": NestedController(sub_model="leaf", num_steps=2),
+        "leaf": SamplingModel(),
+    }
+    search = BestFirstSearch(model_list=model_list, start_model="outer")
+    example = QAExample(qid="1", question="q", gold_answer=None, paras=[])
+    prediction = search.predict(example)
+    final_state = prediction.final_state
+    assert final_state is not None
+    assert not final_state.has_open_node()
+    assert final_state[final_state.root].output == "q.0.0a q.0.1a q.1.0a q.1.1a"